@@ -0,0 +1,90 @@
+'''
+Blend emission inventories on the WRF grid
+
+Each inventory is one layer on the WRF grid:
+    emissions (species, kind, south_north, west_east),
+    mask: fraction (0 ~ 1) of WRF cells using the inventory,
+    priority: number or raster, higher layers cover lower layers.
+The base layer (MEIC) has mask 1 and priority 0.
+
+The weight of each layer is its mask times the uncovered fraction
+    of all higher layers (sorted by priority cell by cell):
+    w_l = m_l * prod(1 - m_h), h: layers above l
+So the blend is one product over layers for all species and kinds:
+    (layer*grid) .* (layer*species*kind*grid) = species*kind*grid
+Species which are missing in some layers are blended by the other layers.
+
+Readers of inventories are modules with three functions (e.g. vito.py):
+    read_inventory(area_defs, yyyy, mm): read the simulated month, return a dict
+        'emi': {species: array (kind, y, x)} in units of WRF-Chem,
+            the kinds are in the order of columns in *_factor.csv
+        'units': {species: units}
+        'lon', 'lat': 1d centers, 'lon_b', 'lat_b': 1d bounds
+    inventory_files(): input files, used by the hashes
+    inventory_settings(): other settings which change the data, used by the hashes
+'''
+
+import logging
+
+import numpy as np
+
+
+def same_units(units, other):
+    '''Compare units written in different styles, e.g. km-2 and km^-2'''
+    def normalize(units):
+        return ' '.join(units.replace('^', '').split())
+
+    return normalize(units) == normalize(other)
+
+
+def blend_weights(masks, priorities):
+    '''
+    Get the weights of layers
+        masks: (layer, south_north, west_east)
+        priorities: (layer, south_north, west_east)
+        return: weights with the same shape as masks
+    '''
+    masks = np.clip(masks, 0, 1)
+    # layers from the top to the bottom of each cell
+    order = np.argsort(-priorities, axis=0, kind='stable')
+    sorted_masks = np.take_along_axis(masks, order, axis=0)
+    uncovered = np.cumprod(1 - sorted_masks, axis=0)
+    uncovered = np.concatenate([np.ones_like(uncovered[:1]), uncovered[:-1]])
+
+    weights = np.empty_like(masks)
+    np.put_along_axis(weights, order, sorted_masks*uncovered, axis=0)
+
+    return weights
+
+
+def blend_layers(layers, names, out):
+    '''
+    Blend the layers into out
+        layers: list of dict with 'names', 'emi' (species, kind, y, x),
+            'mask' (y, x) and 'priority' (y, x)
+        names: species of out
+        out: (species, kind, south_north, west_east)
+    '''
+    # species with the same layers are blended together
+    groups = {}
+    for index, name in enumerate(names):
+        members = tuple(i for i, layer in enumerate(layers) if name in layer['names'])
+        groups.setdefault(members, []).append(index)
+
+    for members, indices in groups.items():
+        if not members:
+            out[indices] = 0
+            continue
+        if members == (0,) and layers[0]['emi'] is out:
+            # just the base layer (mask 1) in place
+            continue
+        logging.info(' '*8 + 'Blend ' + ', '.join(names[index] for index in indices) +
+                     ' of layers ' + ', '.join(layers[i]['name'] for i in members))
+        weights = blend_weights(np.stack([layers[i]['mask'] for i in members]),
+                                np.stack([layers[i]['priority'] for i in members]))
+        stack = np.stack([layers[i]['emi'][[layers[i]['names'].index(names[index])
+                                            for index in indices]]
+                          for i in members])
+        out[indices] = np.einsum('lyx,lskyx->skyx', weights.astype(out.dtype), stack)
+
+    return out
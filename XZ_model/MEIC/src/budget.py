@@ -0,0 +1,126 @@
+'''
+Mass budget of emissions before and after resampling
+
+The domain total of each species and sector is
+    the sum of emission rates multiplied by the area of cells:
+    before: emission grid, area of cells * fraction of cells in the domain
+    after: WRF grid, true area of WRF cells
+Both are calculated by one product over the arrays in memory,
+    then the hourly totals are (time*kind) x (kind*species),
+    because the same temporal factors are applied to both grids.
+The totals after resampling can be summed tile by tile (tiles.py).
+
+The fraction of emission cells in the domain is estimated by
+    nsub*nsub points in each cell, the points are at least
+    twice as dense as WRF cells (4 <= nsub <= 64).
+The points are projected in blocks of emission rows,
+    so the memory is bounded by chunk_size points for any domain.
+'''
+
+import logging
+
+import numpy as np
+import pandas as pd
+from pyproj import Proj
+
+from grid_area import EARTH_RADIUS, get_wrf_area
+
+
+def inside_fraction(lon_b, lat_b, area_def, nsub=None, chunk_size=1000000):
+    '''
+    Get the fraction of emission cells in the WRF domain
+        lon_b, lat_b: 1d bounds of emission grid
+        nsub: number of sub points in each direction of one cell
+        chunk_size: max number of sub points projected at once
+        return: fraction with shape (len(lat_b)-1, len(lon_b)-1)
+    '''
+    if nsub is None:
+        spacing = max(np.abs(np.diff(lon_b)).max(), np.abs(np.diff(lat_b)).max())
+        spacing = np.deg2rad(spacing) * EARTH_RADIUS
+        pixel_size = min(area_def.pixel_size_x, area_def.pixel_size_y)
+        nsub = int(np.clip(np.ceil(2*spacing/pixel_size), 4, 64))
+
+    # sub points of each cell
+    sub = (np.arange(nsub) + 0.5) / nsub
+    lon = (lon_b[:-1, np.newaxis] + np.diff(lon_b)[:, np.newaxis]*sub).ravel()
+    ny, nx = len(lat_b)-1, len(lon_b)-1
+
+    proj = Proj(area_def.proj_str)
+    xmin, ymin, xmax, ymax = area_def.area_extent
+    fraction = np.empty((ny, nx))
+    nrows = max(chunk_size // (lon.size*nsub), 1)
+    for start in range(0, ny, nrows):
+        stop = min(start+nrows, ny)
+        lat = (lat_b[start:stop, np.newaxis] +
+               np.diff(lat_b[start:stop+1])[:, np.newaxis]*sub).ravel()
+        x, y = proj(*np.meshgrid(lon, lat))
+        inside = (x >= xmin) & (x < xmax) & (y >= ymin) & (y < ymax)
+        fraction[start:stop] = inside.reshape(stop-start, nsub, nx, nsub).mean(axis=(1, 3))
+
+    return fraction
+
+
+def domain_totals(emi, area):
+    '''
+    Sum of emission rates * area
+        emi: (..., y, x)
+        area: (y, x)
+        return: (...)
+    '''
+    return emi.reshape(-1, area.size) @ area.ravel().astype(emi.dtype)
+
+
+def emission_totals(emi_list, lon_b, lat_b, emi_area, area_def):
+    '''
+    Get the domain totals before resampling
+        emi_list: arrays (kind, y, x) of species on emission grid
+        return: totals with shape (species, kind)
+    '''
+    area = emi_area * inside_fraction(lon_b, lat_b, area_def)
+
+    return np.array([domain_totals(emi, area) for emi in emi_list])
+
+
+def wrf_totals(wrf_emi, area_def, memoize=True):
+    '''
+    Get the domain (or tile) totals after resampling
+        wrf_emi: (species, kind, south_north, west_east)
+        return: totals with shape (species, kind)
+    '''
+    area = get_wrf_area(area_def, memoize=memoize)
+
+    return domain_totals(wrf_emi, area).reshape(wrf_emi.shape[:2])
+
+
+def budget_totals(emi_list, lon_b, lat_b, emi_area, wrf_emi, area_def):
+    '''
+    Get the domain totals before and after resampling
+        return: totals before and after, both with shape (species, kind)
+    '''
+    return (emission_totals(emi_list, lon_b, lat_b, emi_area, area_def),
+            wrf_totals(wrf_emi, area_def))
+
+
+def report_budget(label, names, before, after, factors, tolerance):
+    '''
+    Log the daily totals and the max relative loss of hourly totals
+        factors: temporal factors (time, kind)
+        return: DataFrame of the budget
+    '''
+    hourly_before = factors @ before.T
+    hourly_after = factors @ after.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        loss = np.where(hourly_before != 0, 1 - hourly_after/hourly_before, 0.)
+
+    df = pd.DataFrame({'species': names,
+                       'before': hourly_before.sum(axis=0),
+                       'after': hourly_after.sum(axis=0),
+                       'max_loss': np.abs(loss).max(axis=0)})
+
+    logging.info(f'Mass budget of {label}:\n' + df.to_string(index=False))
+    for name, max_loss in zip(df['species'], df['max_loss']):
+        if max_loss > tolerance:
+            logging.warning(f'{label} {name}: relative loss of hourly totals '
+                            f'{max_loss:.2%} > {tolerance:.2%}')
+
+    return df
@@ -0,0 +1,81 @@
+'''
+Hashes of wrfchemi* variables for incremental regeneration
+
+The hash of each E_* variable is generated by all of its inputs:
+    the row of conversion table, the content of MEIC files,
+    the temporal factors and Times, the attrs of geo_em file
+    and the resampling settings.
+The hashes of the variables in wrfchemi_*z_d<n> are saved
+    to wrfchemi_d<n>.json in the same directory,
+    then only the variables whose hashes are changed are recomputed
+    and the others are copied from the previous files.
+'''
+
+import hashlib
+import json
+import logging
+import os
+from functools import lru_cache
+
+import numpy as np
+
+
+def calc_hash(*values):
+    '''Get the hash of strings, numbers and arrays'''
+    sha = hashlib.sha1()
+    for value in values:
+        if isinstance(value, np.ndarray):
+            value = np.ascontiguousarray(value)
+            sha.update(f'{value.dtype}{value.shape}'.encode())
+            sha.update(value.tobytes())
+        else:
+            sha.update(repr(value).encode())
+        sha.update(b';')
+
+    return sha.hexdigest()[:16]
+
+
+@lru_cache(maxsize=None)
+def _file_hash(filename, mtime, size, chunk_size=2**24):
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()[:16]
+
+
+def file_hash(filename):
+    '''Get the hash of file content, memoized until the file is modified'''
+    stat = os.stat(filename)
+    return _file_hash(os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+
+
+def manifest_name(chemi_dir, domain):
+    return os.path.join(chemi_dir, f'wrfchemi_{domain}.json')
+
+
+def load_manifest(filename, chemi_files):
+    '''
+    Read hashes of the previous run
+        return: {} if any file doesn't exist
+    '''
+    if not all(os.path.isfile(file) for file in [filename] + chemi_files):
+        return {}
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except ValueError:
+        logging.info(f'Ignore invalid {filename}')
+        return {}
+
+
+def save_manifest(filename, hashes):
+    with open(filename, 'w') as f:
+        json.dump(hashes, f, indent=1)
+
+
+def remove_manifest(filename):
+    '''Remove hashes before the files are modified'''
+    if os.path.isfile(filename):
+        os.remove(filename)
@@ -0,0 +1,109 @@
+'''
+Write wrfchemi* files species by species
+
+The files are created with dims, attrs and Times at first,
+    then each species is written to all files once it is finished,
+    so just one species is kept in memory.
+For tiles, each species is written as hyperslabs of tiles,
+    and the chunks of variables are same as tiles.
+'''
+
+import logging
+import os
+
+import numpy as np
+from netCDF4 import Dataset
+
+dims = ['Time', 'emissions_zdim', 'south_north', 'west_east']
+
+
+def chemi_attrs(vname, units):
+    '''Attrs needed by WRF-Chem'''
+    return {'FieldType': 104,
+            'MemoryOrder': 'XYZ',
+            'description': vname,
+            'stagger': '',
+            'coordinates': 'XLONG XLAT',
+            'units': units
+            }
+
+
+class chemi_writer(object):
+    '''
+    Write species to wrfchemi* files
+        filenames: the Times are split into len(filenames) files equally,
+            e.g. [wrfchemi_00z_d01, wrfchemi_12z_d01] for 24 hours
+        Times: strings of time, e.g. 2019-07-25_00:00:00
+        shape: (south_north, west_east)
+        attrs: global attrs (attrs of geo_em file)
+        tile_size: size of tiles written by hyperslabs
+    '''
+    def __init__(self, filenames, Times, shape, attrs,
+                 nz=1, complevel=5, tile_size=None):
+        self.filenames = filenames
+        self.shape = tuple(shape)
+        self.complevel = complevel
+        Times = np.array(Times, dtype=np.dtype(('S', 19)))
+        ntime = len(Times) // len(filenames)
+        self.tindex = [slice(i*ntime, (i+1)*ntime)
+                       for i in range(len(filenames))]
+        if tile_size is None:
+            self.chunksizes = None
+        else:
+            self.chunksizes = (1, nz, min(tile_size, shape[0]), min(tile_size, shape[1]))
+
+        self.files = []
+        for filename, tindex in zip(filenames, self.tindex):
+            chemi_dir = os.path.dirname(filename)
+            if chemi_dir:
+                # domains may create it at the same time
+                os.makedirs(chemi_dir, exist_ok=True)
+
+            logging.info(f'Creating {filename}')
+            nc = Dataset(filename, 'w', format='NETCDF4')
+            nc.createDimension('Time', None)
+            nc.createDimension('DateStrLen', 19)
+            nc.createDimension('emissions_zdim', nz)
+            nc.createDimension('south_north', shape[0])
+            nc.createDimension('west_east', shape[1])
+            nc.setncatts({key: value for key, value in attrs.items()})
+
+            nc_times = nc.createVariable('Times', 'S1', ('Time', 'DateStrLen'),
+                                         zlib=True, complevel=complevel)
+            # (Time) -> (Time, DateStrLen)
+            nc_times[:] = Times[tindex].view('S1').reshape(-1, 19)
+            self.files.append(nc)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, vname, data, attrs, dtype=np.float64, index=None):
+        '''
+        Write one species to all files
+            data: (Time, emissions_zdim, south_north, west_east)
+            index: (slice of south_north, slice of west_east) of the tile,
+                None: the whole domain
+        '''
+        if index is None:
+            logging.info(f'Writing {vname} ...')
+        else:
+            logging.debug(' '*8 + f'Writing {vname} of tile {index} ...')
+        for nc, tindex in zip(self.files, self.tindex):
+            if vname not in nc.variables:
+                var = nc.createVariable(vname, dtype, dims,
+                                        zlib=True, complevel=self.complevel,
+                                        chunksizes=self.chunksizes)
+                var.setncatts(attrs)
+            if index is None:
+                nc.variables[vname][:] = data[tindex]
+            else:
+                ntime = tindex.stop - tindex.start
+                nc.variables[vname][:ntime, :, index[0], index[1]] = data[tindex]
+
+    def close(self, ):
+        for nc in self.files:
+            if nc.isopen():
+                nc.close()
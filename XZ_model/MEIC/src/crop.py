@@ -0,0 +1,112 @@
+'''
+Crop emission grids to the footprint of WRF domains
+
+The lon/lat box of all WRF domains is extended by radius_of_influence,
+    then only the emission cells overlapping the box are
+    read, converted and resampled.
+Cells out of the box are never used by the resampling weights,
+    so the results are same as the whole emission grid.
+'''
+
+import logging
+
+import numpy as np
+from pyproj import Proj
+
+from grid_area import EARTH_RADIUS
+
+
+def boundary_lonlats(area_def):
+    '''
+    Get the lon/lat of cells at the edges of the area,
+        the lon/lat of the whole area (e.g. 1 km domains) is never allocated
+        return: lons, lats (1d)
+    '''
+    ny, nx = area_def.shape
+    edges = [(0, slice(None)), (ny-1, slice(None)),
+             (slice(None), 0), (slice(None), nx-1)]
+    lonlats = [area_def.get_lonlats(data_slice=edge) for edge in edges]
+
+    return (np.concatenate([np.ravel(lon) for lon, _ in lonlats]),
+            np.concatenate([np.ravel(lat) for _, lat in lonlats]))
+
+
+def contains_pole(area_def):
+    '''Check whether the poles are in the area: return (north, south)'''
+    x_ll, y_ll, x_ur, y_ur = area_def.area_extent
+    proj = Proj(area_def.proj_str)
+    inside = []
+    for lat in (90., -90.):
+        x, y = proj(0., lat)
+        inside.append(bool(np.isfinite(x) and np.isfinite(y) and
+                           x_ll <= x <= x_ur and y_ll <= y <= y_ur))
+
+    return inside
+
+
+def domain_bbox(area_defs, radius_of_influence):
+    '''
+    Get the lon/lat box of all domains
+        the lon/lat extremes of WRF projections are at the edges,
+        unless the domain covers the pole
+        return: (west, east, south, north)
+    '''
+    lons, lats = [], []
+    for area_def in area_defs:
+        lon, lat = boundary_lonlats(area_def)
+        lons.extend([np.nanmin(lon), np.nanmax(lon)])
+        lats.extend([np.nanmin(lat), np.nanmax(lat)])
+        north, south = contains_pole(area_def)
+        if north:
+            lons.extend([-180., 180.])
+            lats.append(90.)
+        if south:
+            lons.extend([-180., 180.])
+            lats.append(-90.)
+
+    # margin in degrees
+    dlat = np.rad2deg(radius_of_influence / EARTH_RADIUS)
+    south = max(min(lats) - dlat, -90.)
+    north = min(max(lats) + dlat, 90.)
+    coslat = np.cos(np.deg2rad(max(abs(south), abs(north))))
+    if coslat < 1e-6:
+        # the box covers the pole
+        west, east = -180., 180.
+    else:
+        dlon = min(dlat / coslat, 180.)
+        west, east = min(lons) - dlon, max(lons) + dlon
+
+    return west, east, south, north
+
+
+def bounds_slice(bounds, lower, upper):
+    '''Slice of cells (bounds can be ascending or descending) overlapping [lower, upper]'''
+    cell_lower = np.minimum(bounds[:-1], bounds[1:])
+    cell_upper = np.maximum(bounds[:-1], bounds[1:])
+    index = np.flatnonzero((cell_upper > lower) & (cell_lower < upper))
+    if index.size == 0:
+        raise ValueError(f'Emission grid ({bounds.min()} ~ {bounds.max()}) '
+                         f'does not overlap the domains ({lower} ~ {upper})')
+
+    return slice(index[0], index[-1]+1)
+
+
+def crop_window(lon_b, lat_b, bbox, level=logging.INFO):
+    '''
+    Get the window of cells overlapping the box
+        lon_b, lat_b: 1d bounds of emission grid
+        bbox: (west, east, south, north)
+        level: logging level of the cut, e.g. DEBUG for tiles
+        return: (slice of y, slice of x)
+    '''
+    west, east, south, north = bbox
+    window = (bounds_slice(lat_b, south, north),
+              bounds_slice(lon_b, west, east))
+
+    ny, nx = len(lat_b)-1, len(lon_b)-1
+    ncell = (window[0].stop-window[0].start) * (window[1].stop-window[1].start)
+    logging.log(level, f'Crop the emission grid from {ny}*{nx} to '
+                 f'{window[0].stop-window[0].start}*{window[1].stop-window[1].start} '
+                 f'({100*(1-ncell/(ny*nx)):.1f}% cut)')
+
+    return window
@@ -0,0 +1,169 @@
+'''
+WRF domains and resampling shared by the inventories
+
+The readers (MEIC of mozcart.py, VITO of vito.py and the inventories
+    of blend.py) just convert their files into stacks on regular grids:
+    emi: (species, kind, y, x)
+    grid: {'lon', 'lat': 1d centers, 'lon_b', 'lat_b': 1d bounds}
+The WRF side is shared by all of them:
+    get_info: AreaDefinition of geo_em file, read once per domain,
+        so all inventories of one run use the same target grid
+    resample_domain: all species and kinds in one product,
+        for the whole domain or tile by tile (resample_tiles)
+    perdelta/get_times: times of wrfchemi* files
+The areas (grid_area.py) and weights (regrid.py) are cached by hashes,
+    and chemi_writer.py writes the species one by one.
+'''
+
+import logging
+from datetime import timedelta
+from functools import lru_cache
+from time import strftime
+
+import numpy as np
+import xarray as xr
+from pyresample.geometry import AreaDefinition, SwathDefinition
+
+from parallel import imap_jobs, init_shared, map_jobs, shared
+from regrid import (apply_pool_weights, apply_weights, get_weights,
+                    init_pool_weights, to_wrf_order)
+from tiles import resample_tile, split_tiles
+
+wrf_projs = {1: 'lcc',
+             2: 'npstere',
+             3: 'merc',
+             6: 'eqc'
+             }
+
+
+@lru_cache(maxsize=None)
+def get_info(data_path, domain):
+    '''
+    Read basic info from geo file generated by WPS
+        If want to run this on your laptop and care about the space,
+        you can use ncks to subset the nc file (we just need attrs)
+        ncks -F -d Time,1,,1000 -v Times geo_em.d01.nc geo_em.d01_subset.nc
+    ref: https://fabienmaussion.info/2018/01/06/wrf-projection/
+        return: geo Dataset, AreaDefinition
+    '''
+    geo = xr.open_dataset(data_path + 'geo_em.'+domain+'.nc')
+    attrs = geo.attrs
+    i = attrs['WEST-EAST_GRID_DIMENSION'] - 1
+    j = attrs['SOUTH-NORTH_GRID_DIMENSION'] - 1
+
+    # calculate attrs for area definition
+    shape = (j, i)
+    radius = (i*attrs['DX']/2, j*attrs['DY']/2)
+
+    # create area as same as WRF
+    area_id = 'wrf_circle'
+    proj_dict = {'proj': wrf_projs[attrs['MAP_PROJ']],
+                 'lat_0': attrs['CEN_LAT'],
+                 'lon_0': attrs['CEN_LON'],
+                 'lat_1': attrs['TRUELAT1'],
+                 'lat_2': attrs['TRUELAT2'],
+                 'a': 6370000,
+                 'b': 6370000}
+    center = (0, 0)
+    area_def = AreaDefinition.from_circle(area_id,
+                                          proj_dict,
+                                          center,
+                                          radius,
+                                          shape=shape)
+    logging.info(f'Area of {domain}: {area_def}')
+
+    return geo, area_def
+
+
+def perdelta(start, end, delta):
+    '''Generate the 24-h datetime list'''
+    curr = start
+    while curr <= end:
+        yield curr
+        curr += delta
+
+
+def get_times(st, et, delta):
+    '''Create Times variable'''
+    # generate date every delta hours
+    t_format = '%Y-%m-%d_%H:%M:%S'
+    Times = [strftime(t_format, timstep.timetuple())
+             for timstep in perdelta(st, et, timedelta(hours=delta))]
+
+    # the method of creating "Times" with unlimited dimension
+    # ref: htttps://github.com/pydata/xarray/issues/3407
+    return xr.DataArray(np.array(Times,
+                                 dtype=np.dtype(('S', 19))
+                                 ),
+                        dims=['Time'])
+
+
+def resample_tiles(emi, grid, area_def, geo_attrs, method, radius_of_influence,
+                   tiles, cache_dir=None, nprocs=1):
+    '''
+    Resample the stack tile by tile, the grid is shared by processes once
+        return: iterator of (tile, array (species, kind, tile_y, tile_x)),
+            so each tile can be written before the next one
+    '''
+    try:
+        yield from zip(tiles, imap_jobs(resample_tile,
+                                        [(area_def, tile, geo_attrs, method,
+                                          radius_of_influence, cache_dir) for tile in tiles],
+                                        nprocs,
+                                        initializer=init_shared,
+                                        initargs=(dict(grid, emi=emi),)))
+    finally:
+        shared.clear()
+
+
+def resample_domain(emi, grid, area_def, geo_attrs, method, radius_of_influence,
+                    cache_dir=None, nprocs=1, tile_size=None, nprocs_tile=1):
+    '''
+    Resample the stack of all species and kinds to the WRF domain
+        nprocs: number of processes for species (the whole domain)
+        tile_size: resample tiles of tile_size*tile_size cells in nprocs_tile processes
+        return: array (species, kind, south_north, west_east)
+    '''
+    wrf_emi = np.empty(emi.shape[:2] + area_def.shape, dtype=emi.dtype)
+
+    if tile_size is not None:
+        tiles = split_tiles(area_def.shape, tile_size)
+        logging.info(f'Split {area_def.shape} into {len(tiles)} tiles')
+        for tile, tile_emi in resample_tiles(emi, grid, area_def, geo_attrs,
+                                             method, radius_of_influence, tiles,
+                                             cache_dir=cache_dir, nprocs=nprocs_tile):
+            wrf_emi[(slice(None), slice(None)) + tile] = tile_emi
+
+        return wrf_emi
+
+    # different resample methods
+    #   conservative: keep the total of emissions
+    # see: http://earthpy.org/interpolation_between_grids_with_pyresample.html
+    # the weights are calculated once and shared by all species and sectors
+    lon2d, lat2d = np.meshgrid(grid['lon'], grid['lat'])
+    weights = get_weights(SwathDefinition(lons=lon2d, lats=lat2d),
+                          area_def,
+                          geo_attrs,
+                          method,
+                          radius_of_influence,
+                          cache_dir=cache_dir,
+                          bounds=(grid['lon_b'], grid['lat_b']))
+
+    # rows of WRF start from the south
+    #   and the product keeps the precision of emissions
+    weights = to_wrf_order(weights, area_def.shape).astype(emi.dtype)
+
+    if nprocs > 1:
+        # resample species in parallel
+        results = map_jobs(apply_pool_weights,
+                           list(emi),
+                           nprocs,
+                           initializer=init_pool_weights,
+                           initargs=(weights, area_def.shape))
+        for index, resampled in enumerate(results):
+            wrf_emi[index] = resampled
+    else:
+        # resample the whole stack into the preallocated array
+        apply_weights(weights, emi, area_def.shape, out=wrf_emi)
+
+    return wrf_emi
@@ -0,0 +1,97 @@
+'''
+Downscale coarse emissions onto fine WRF cells by proxies
+
+The mass of each emission cell in the domain is kept like the
+    conservative method (regrid.py), but it is distributed over the
+    WRF cells by proxies (e.g. population, road density or gridded
+    point sources) instead of the overlap area:
+    D = diag(p) * C * diag(s), s_j = sum_i(C_ij) / sum_i(p_i*C_ij)
+    C: conservative weights (n_wrf_grid * n_emi_grid)
+    p: proxy of WRF cells
+Emission cells without any proxy inside are kept as conservative,
+    so downscaling all species of one sector is still one sparse product.
+
+Rasters (proxies, or masks of blend.py) are variables of netCDF files:
+    on the WRF grid (south_north, west_east), e.g. saved from geo_em files,
+    or on a regular lon/lat grid (1d lon/lat coordinates), which is
+    cropped to the domain and resampled to WRF cells conservatively.
+The values are densities (per area), only the relative values
+    in each emission cell are used.
+'''
+
+import logging
+
+import numpy as np
+import xarray as xr
+from scipy import sparse
+
+from regrid import resample_grid
+
+wrf_dims = ('south_north', 'west_east')
+
+
+def center_bounds(centers):
+    '''Get the bounds of regular cells by 1d centers'''
+    centers = np.asarray(centers, dtype=np.float64)
+    half = np.diff(centers) / 2
+    inner = centers[:-1] + half
+
+    return np.concatenate(([centers[0] - half[0]], inner, [centers[-1] + half[-1]]))
+
+
+def read_raster(filename, varname, area_def, geo_attrs, cache_dir=None):
+    '''
+    Read the raster (e.g. proxy) and map it to the WRF grid
+        return: raster with shape (south_north, west_east), rows start from the south
+    '''
+    logging.info(' '*8 + f'Reading {varname} from {filename}')
+    with xr.open_dataset(filename) as ds:
+        da = ds[varname].squeeze(drop=True)
+
+        if da.dims[-2:] == wrf_dims:
+            if da.shape != area_def.shape:
+                raise ValueError(f'Shape of {varname} {da.shape} is different '
+                                 f'from the domain {area_def.shape}')
+            raster = da.values.astype(np.float64)
+        else:
+            lon_name = 'lon' if 'lon' in da.coords else 'longitude'
+            lat_name = 'lat' if 'lat' in da.coords else 'latitude'
+            da = da.transpose(lat_name, lon_name)
+            # just the raster around the domain is read
+            raster = resample_grid(da,
+                                   da[lon_name].values,
+                                   da[lat_name].values,
+                                   center_bounds(da[lon_name]),
+                                   center_bounds(da[lat_name]),
+                                   area_def,
+                                   geo_attrs,
+                                   'conservative',
+                                   max(area_def.pixel_size_x, area_def.pixel_size_y),
+                                   cache_dir=cache_dir,
+                                   fill_nan=True)
+
+    # missing or negative values are zero
+    return np.clip(np.nan_to_num(raster), 0, None)
+
+
+def proxy_operator(weights, proxy):
+    '''
+    Get the downscaling matrix
+        weights: conservative weights (n_wrf_grid * n_emi_grid) in WRF order
+        proxy: (south_north, west_east)
+        return: sparse matrix with the same shape as weights
+    '''
+    weighted = sparse.diags(np.ravel(proxy)) @ weights
+    total = np.asarray(weights.sum(axis=0)).ravel()
+    proxy_total = np.asarray(weighted.sum(axis=0)).ravel()
+
+    has_proxy = proxy_total > 0
+    scale = np.divide(total, proxy_total,
+                      out=np.zeros_like(total), where=has_proxy)
+    nmissing = np.count_nonzero(~has_proxy & (total > 0))
+    if nmissing:
+        logging.info(' '*8 + f'{nmissing} emission cells without proxy '
+                     'are resampled conservatively')
+
+    return (weighted @ sparse.diags(scale) +
+            weights @ sparse.diags((~has_proxy).astype(np.float64))).tocsr()
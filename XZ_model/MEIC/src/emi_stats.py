@@ -0,0 +1,93 @@
+'''
+Summary statistics of emissions
+
+min, max, mean, sum and the number of NaN are calculated
+    in one pass of the array which is already in memory,
+    chunk by chunk, so each chunk is read from memory once.
+Statistics of tiles are merged into one row of the whole domain.
+The statistics are always collected (the cost doesn't depend on
+    the logging level) and reported as one table at the end of run.
+'''
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+columns = ['stage', 'species', 'min', 'max', 'mean', 'sum', 'nan']
+
+
+def calc_stats(data, chunk_size=2**20):
+    '''Calculate min, max, mean, sum and the number of NaN in one pass'''
+    flat = np.ravel(np.asarray(data))
+    vmin, vmax, vsum = np.inf, -np.inf, 0.
+    nnan = 0
+    for start in range(0, flat.size, chunk_size):
+        chunk = flat[start:start+chunk_size]
+        nan = np.isnan(chunk)
+        n = nan.sum()
+        if n:
+            nnan += int(n)
+            chunk = chunk[~nan]
+        if chunk.size:
+            vmin = min(vmin, chunk.min())
+            vmax = max(vmax, chunk.max())
+            vsum += chunk.sum(dtype=np.float64)
+
+    nvalid = flat.size - nnan
+    if nvalid == 0:
+        vmin = vmax = np.nan
+
+    return {'min': float(vmin),
+            'max': float(vmax),
+            'mean': vsum / nvalid if nvalid else np.nan,
+            'sum': float(vsum),
+            'nan': nnan,
+            'count': nvalid}
+
+
+def merge_stats(row, stats):
+    '''Merge statistics of another part of the array into row'''
+    count = row['count'] + stats['count']
+    row['min'] = float(np.fmin(row['min'], stats['min']))
+    row['max'] = float(np.fmax(row['max'], stats['max']))
+    row['sum'] += stats['sum']
+    row['nan'] += stats['nan']
+    row['count'] = count
+    row['mean'] = row['sum'] / count if count else np.nan
+
+    return row
+
+
+class stats_table(object):
+    '''Collect statistics of species in one run'''
+    def __init__(self, ):
+        self.rows = []
+
+    def add(self, stage, name, data, merge=False):
+        '''
+        Add statistics of data and log them in debug mode
+            merge: merge into the row of same stage and name (e.g. tiles)
+        '''
+        row = dict(stage=stage, species=name, **calc_stats(data))
+        previous = [prev for prev in self.rows
+                    if merge and prev['stage'] == stage and prev['species'] == name]
+        if previous:
+            row = merge_stats(previous[-1], row)
+        else:
+            self.rows.append(row)
+        logging.debug(' '*8 + name +
+                      ' min: ' + str(row['min']) +
+                      ' max: ' + str(row['max']) +
+                      ' mean ' + str(row['mean'])
+                      )
+
+        return row
+
+    def to_dataframe(self, ):
+        return pd.DataFrame(self.rows, columns=columns)
+
+    def log(self, level=logging.INFO):
+        '''Log all statistics as one table'''
+        logging.log(level, 'Statistics of emissions:\n' +
+                    self.to_dataframe().to_string(index=False))
@@ -0,0 +1,103 @@
+'''
+Calculate the area (m2) of cells in regular lon/lat emission grids
+
+The area of one cell is the difference of two spherical caps
+    multiplied by the fraction of longitude it covers,
+    so the whole grid is an outer product of two 1d arrays.
+ref: https://github.com/Timothy-W-Hilton/STEMPyTools
+
+Areas are memoized by the hash of (lon_bounds, lat_bounds)
+    and can be saved as area_<hash>.npy in cache_dir.
+
+The area of WRF cells is dx*dy divided by the areal scale
+    (square of map factor) of the projection at the cell centers.
+'''
+
+import hashlib
+import logging
+import os
+
+import numpy as np
+from pyproj import Proj
+
+EARTH_RADIUS = 6370000.0
+
+# memoized areas in this run
+_area_cache = {}
+
+
+def bounds_hash(lon_b, lat_b):
+    '''Get the hash of lon/lat bounds'''
+    sha = hashlib.sha1()
+    for bounds in (lon_b, lat_b):
+        bounds = np.ascontiguousarray(bounds, dtype=np.float64)
+        sha.update(str(bounds.shape).encode())
+        sha.update(bounds.tobytes())
+
+    return sha.hexdigest()[:16]
+
+
+def calc_grid_area(lon_b, lat_b):
+    '''
+    Calculate area (m2) of the grid defined by 1d lon/lat bounds
+        lon_b: (xdim+1), lat_b: (ydim+1)
+        return: area with shape (ydim, xdim)
+    '''
+    lon_b = np.asarray(lon_b, dtype=np.float64)
+    lat_b = np.asarray(lat_b, dtype=np.float64)
+
+    cap_area = 2 * np.pi * EARTH_RADIUS**2 * (1 - np.sin(np.deg2rad(lat_b)))
+
+    return np.outer(np.abs(np.diff(cap_area)),
+                    np.abs(np.diff(lon_b)) / 360.0)
+
+
+def get_grid_area(lon_b, lat_b, cache_dir=None):
+    '''
+    Get the memoized area of grid,
+        if cache_dir is set, the area is read from or saved to
+        <cache_dir>/area_<hash>.npy
+    '''
+    key = bounds_hash(lon_b, lat_b)
+    if key in _area_cache:
+        return _area_cache[key]
+
+    filename = None
+    if cache_dir is not None:
+        filename = os.path.join(cache_dir, f'area_{key}.npy')
+
+    if filename is not None and os.path.isfile(filename):
+        logging.info(f'Reading area from {filename}')
+        area = np.load(filename)
+    else:
+        area = calc_grid_area(lon_b, lat_b)
+        if filename is not None:
+            logging.info(f'Saving area to {filename}')
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(filename, area)
+
+    _area_cache[key] = area
+
+    return area
+
+
+def get_wrf_area(area_def, memoize=True):
+    '''
+    Get the memoized area (m2) of WRF cells
+        memoize: False for tiles, so the memory is bounded by one tile
+        return: area with shape (south_north, west_east)
+    '''
+    key = ('wrf', area_def.proj_str, area_def.area_extent, area_def.shape)
+    if memoize and key in _area_cache:
+        return _area_cache[key]
+
+    lons, lats = area_def.get_lonlats()
+    factors = Proj(area_def.proj_str).get_factors(lons, lats)
+    area = area_def.pixel_size_x * area_def.pixel_size_y / factors.areal_scale
+    # rows of WRF start from the south
+    area = area[::-1, :]
+
+    if memoize:
+        _area_cache[key] = area
+
+    return area
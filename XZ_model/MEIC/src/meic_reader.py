@@ -0,0 +1,110 @@
+'''
+Index and read MEIC nc files
+
+The <yyyy>/<mechanism>/ tree is indexed once,
+    then each (sector, species) file is read exactly once
+    into one cube with dims (species, kind, y, x).
+
+The 1d array of MEIC nc file (GMT grd format) starts from the north,
+    the cube is flipped to start from the south like the lat bounds.
+If the window (rows and columns starting from the south) is set,
+    just the block of rows in the window is read from each file.
+The species are read in nprocs processes (parallel.imap_jobs),
+    and each one is put into the cube once it is read.
+'''
+
+import logging
+import os
+from glob import glob
+
+import numpy as np
+import xarray as xr
+
+from parallel import imap_jobs
+
+# grid variables which should be same in all files
+grid_vars = ['x_range', 'y_range', 'spacing', 'dimension']
+
+
+def index_files(emi_path, mechanisms):
+    '''
+    Index MEIC files under emi_path/<mechanism>/
+        return: {(mechanism, species): [files sorted by sector]}
+        the files are sorted like:
+            agriculture, industry, power, residential and transportation
+    '''
+    index = {}
+    for mechanism in mechanisms:
+        for file in sorted(glob(os.path.join(emi_path, mechanism, '*.nc'))):
+            # <yyyy>_<mm>__<sector>__<mechanism>_<species>.nc
+            species = os.path.basename(file)[:-3].rsplit('_', 1)[-1]
+            index.setdefault((mechanism, species), []).append(file)
+
+    return index
+
+
+def sector_name(file):
+    '''Get the sector from <yyyy>_<mm>__<sector>__<mechanism>_<species>.nc'''
+    return os.path.basename(file).split('__')[1]
+
+
+def read_grid(file):
+    '''Read the grid variables of MEIC file'''
+    with xr.open_dataset(file) as ds:
+        return {var: ds[var].values for var in grid_vars}
+
+
+def read_species(job):
+    '''
+    Read the files (sectors) of one species
+        job: (key, files, grid, window, first file, dtype)
+        return: array (kind, y, x) of the window
+    '''
+    key, files, grid, window, first, dtype = job
+    xdim, ydim = grid['dimension']
+    y, x = window
+    # rows of the window in the file starting from the north
+    start = (ydim - y.stop) * xdim
+    stop = (ydim - y.start) * xdim
+
+    logging.info(' '*10+'Reading '+key[1]+' species ....')
+    species = np.zeros((len(files), y.stop-y.start, x.stop-x.start), dtype=dtype)
+    for k, file in enumerate(files):
+        with xr.open_dataset(file) as ds:
+            for var in grid_vars:
+                if not np.array_equal(ds[var].values, grid[var]):
+                    raise ValueError(f'{var} of {file} is different from {first}')
+            z = ds['z'][start:stop].values.reshape(-1, xdim)[:, x]
+            valid = z != ds['z'].attrs['nodata_value']
+            species[k] = np.flip(np.where(valid, z, 0.), 0)
+
+    return species
+
+
+def read_cube(index, keys, dtype=np.float64, window=None, nprocs=1):
+    '''
+    Read files of species (keys) into the cube
+        dtype: precision of the cube
+        window: (slice of y, slice of x), default: the whole grid
+        nprocs: number of processes for species
+        return: cube (species, kind, y, x), grid of the first file
+    '''
+    first = index[keys[0]][0]
+    grid = read_grid(first)
+    xdim, ydim = grid['dimension']
+    nkind = len(index[keys[0]])
+    if window is None:
+        window = (slice(0, ydim), slice(0, xdim))
+    y, x = window
+
+    for key in keys:
+        if len(index[key]) != nkind:
+            raise ValueError(f'{key} has {len(index[key])} files, '
+                             f'while {keys[0]} has {nkind} files')
+
+    cube = np.empty((len(keys), nkind, y.stop-y.start, x.stop-x.start), dtype=dtype)
+    jobs = [(key, index[key], grid, window, first, dtype) for key in keys]
+    for i, species in enumerate(imap_jobs(read_species, jobs, nprocs)):
+        cube[i] = species
+
+    return cube, grid
@@ -4,8 +4,8 @@ INPUT:
     MEIC input files
 
 OUTPUT:
-    wrfchemi_00z_d01: 0 ~ 11 h
-    wrfchemi_12z_d01: 12 ~ 23 h
+    wrfchemi_00z_d<domain>: 0 ~ 11 h
+    wrfchemi_12z_d<domain>: 12 ~ 23 h
 
 UPDATE:
     Xin Zhang:
@@ -16,31 +16,66 @@ Steps:
     1. Create WRF area by reading the info of geo* file
     2. Read MEIC nc files and map species to WRF-Chem species
         and assign to self.emi[species]
-    3. Resample self.emi to WRF area, write attributes,
-        and assign to self.chemi[species]
-    4. Export self.chemi to two 12-hour netCDF files.
+    3. Resample self.emi of each sector to WRF area,
+        or downscale it by the proxies of the sector (proxy_files)
+    4. Apply monthly, weekly and hourly factors of each day,
+        and write species one by one to two 12-hour netCDF files.
+        If sector_tags is True, E_<SPEC>_<SECTOR> are also written.
+        If scenario_file is set, files of each scenario are also written
+        by scaling the same resampled emissions.
+        If vertical_factor.csv exists, sectors are distributed into
+        emissions_zdim levels together with the temporal factors.
+    Step 1, 3 and 4 are run for each domain in parallel,
+        while MEIC files are just read and converted once.
+    If inventories is set, they are read once after step 2,
+        resampled in step 3 and blended with MEIC by masks
+        and priorities (blend.py) before step 4.
+    If crop is True, MEIC is cropped to the domains before step 2.
+    If tile_size is set, step 3 and 4 are run tile by tile,
+        each tile is written as hyperslabs of the files.
 
 Currently, this script just supports MOZCART mechanism.
-If you want to apply to other mechanisms, you need to edit:
-    1. conversion_table_dtype (below);
-    2. conversion_table.csv
+If you want to apply to other mechanisms, you just need to edit
+    conversion_table.csv
 
 '''
 
+import importlib
 import logging
-import warnings
 import os
+import warnings
 from calendar import monthrange
 from datetime import datetime, timedelta
-from glob import glob
-from time import strftime
+from itertools import product
 
 import numpy as np
-import pandas as pd
 import xarray as xr
-from pyresample.bilinear import resample_bilinear
-from pyresample.geometry import AreaDefinition, SwathDefinition
-from pyresample.kd_tree import resample_custom, resample_nearest
+from netCDF4 import Dataset
+from pyresample.geometry import SwathDefinition
+
+from blend import blend_layers, same_units
+from budget import (budget_totals, emission_totals, report_budget,
+                    wrf_totals)
+from chemi_cache import (calc_hash, file_hash, load_manifest, manifest_name,
+                         remove_manifest, save_manifest)
+from chemi_writer import chemi_attrs, chemi_writer
+from crop import crop_window, domain_bbox
+from domain import (get_info, get_times, perdelta, resample_domain,
+                    resample_tiles)
+from downscale import proxy_operator, read_raster
+from emi_stats import stats_table
+from grid_area import get_grid_area
+from meic_reader import index_files, read_cube, read_grid, sector_name
+from parallel import init_shared, map_jobs, shared
+from regrid import (apply_weights, get_weights, resample_grid, to_wrf_order,
+                    weights_hash)
+from scenario import load_scenarios, scenario_factors
+from speciation import (apply_speciation, compile_table, read_table,
+                        species_groups)
+from temporal import apply_factors, temporal_factors
+from tiles import split_tiles, tile_area_def
+from vertical import load_vertical, vertical_factors
+
 warnings.filterwarnings('ignore', category=RuntimeWarning, append=True)
 
 # Choose the following line for info or debugging:
@@ -50,8 +85,60 @@ logging.basicConfig(level=logging.DEBUG)
 # --- input --- #
 data_path = '../input_files/'
 output_dir = '../output_files/'
-domain = 'd01'
-resample_method = 'bilinear'  # nearest, bilinear or idw
+# all domains share the MEIC data read once, e.g. ['d01', 'd02', 'd03']
+domains = ['d01']
+# number of processes for domains
+nprocs_domain = len(domains)
+resample_method = 'bilinear'  # nearest, bilinear, idw or conservative
+# resampling weights are saved to cache_dir
+cache_dir = '../cache_files/'
+# number of processes for reading and resampling species
+nprocs = 1
+# save cell areas of MEIC grid to data_path/<yyyy_emi>/area_<hash>.npy
+save_area = True
+# just update the species whose inputs are changed in existing output files
+#   hashes of inputs are saved to wrfchemi_d<n>.json beside the files
+incremental = True
+# precision of emissions from reading to writing
+#   WRF-Chem reads emissions as REAL (float32)
+emi_dtype = np.float32
+# just read MEIC cells in the box of domains plus radius_of_influence
+crop = True
+# compare domain totals before and after resampling,
+#   and warn if the relative loss of any hourly total > budget_tol
+check_budget = True
+budget_tol = 0.05
+# YAML file of scenarios (factors of sectors and species), e.g.
+#   './scenario_example.yaml', files are saved to output_dir/<scenario>/
+scenario_file = None
+# number of processes for writing files (days and scenarios) of each domain
+nprocs_output = 1
+# split domains into tiles of tile_size*tile_size cells (e.g. 500 for 1 km domains),
+#   each tile is resampled and written before the next one,
+#   so the memory is bounded by tiles. None: the whole domain at once
+tile_size = None
+# number of processes for tiles of each domain
+nprocs_tile = 1
+# downscale MEIC cells onto WRF cells by proxy rasters of sectors,
+#   {sector: (filename, variable)}, {domain} in filename is replaced, e.g.
+#   {'residential': ('../input_files/population.nc', 'population'),
+#    'transportation': ('../input_files/roads_{domain}.nc', 'road_density')}
+#   the rasters are on the WRF grid or regular lon/lat grids (see downscale.py),
+#   the mass of MEIC cells is kept like the conservative method,
+#   other sectors are resampled conservatively. {}: no downscaling
+proxy_files = {}
+# blend other inventories with MEIC on the WRF grid (see blend.py),
+#   {name: {'reader': module, 'priority': number or (filename, variable),
+#           'mask': (filename, variable)}}, {domain} in filename is replaced, e.g.
+#   {'vito': {'reader': 'vito', 'priority': 1,
+#             'mask': ('../input_files/east_china_{domain}.nc', 'mask')}}
+#   each inventory is used in its mask (default: the whole inventory grid),
+#   higher priority covers lower priorities, MEIC has priority 0,
+#   species which are not in MEIC are skipped. {}: just MEIC
+inventories = {}
+# also write emissions of each sector (E_<SPEC>_<SECTOR>, e.g. E_CO_POWER)
+#   beside the totals for source attribution
+sector_tags = False
 
 # emission year
 yyyy_emi = 2016
@@ -60,408 +147,665 @@ yyyy_emi = 2016
 yyyy = 2019
 mm = 7
 dd = 25
+# last simulated day in the month (dd_end = dd: just one day)
+#   if dd_end > dd, files of each day are saved to output_dir/<yyyymmdd>/
+#   e.g. dd = 1 and dd_end = monthrange(yyyy, mm)[1] for the whole month
+dd_end = 25
 
 # ------------- #
-conversion_table_dtype = {'MOZCART': str,
-                          'CB05': str,
-                          'RADM2': str,
-                          'SAPRC99': str,
-                          'SAPRC07': str,
-                          'ALL': str,
-                          'WEIGHT': np.float64,
-                          'SOLID': np.int,
-                          'VOC': np.int,
-                          'MW': np.int,
-                          }
-
 # Please don't change the following paras
 minhour = 0
 maxhour = 23
 delta = 1  # unit: hour
 days = monthrange(yyyy, mm)[1]  # get number of days of the month
-chem1 = output_dir+"wrfchemi_00z_d"+domain
-chem2 = output_dir+"wrfchemi_12z_d"+domain
-
-wrf_projs = {1: 'lcc',
-             2: 'npstere',
-             3: 'merc',
-             6: 'eqc'
-             }
+# downscaling keeps the mass of MEIC cells like the conservative method
+weights_method = 'conservative' if proxy_files else resample_method
 
 
 class meic(object):
     def __init__(self, st, et, delta):
-        self.get_info()
-        self.read_meic()
-        self.resample_WRF(st, et, delta)
-        self.create_file()
-
-    def get_info(self, ):
-        '''
-        Read basic info from geo file generated by WPS
-            If want to run this on your laptop and care about the space,
-            you can use ncks to subset the nc file (we just need attrs)
-            ncks -F -d Time,1,,1000 -v Times geo_em.d01.nc geo_em.d01_subset.nc
-        ref: https://fabienmaussion.info/2018/01/06/wrf-projection/
-        '''
-        self.geo = xr.open_dataset(data_path + 'geo_em.'+domain+'.nc')
-        attrs = self.geo.attrs
-        i = attrs['WEST-EAST_GRID_DIMENSION'] - 1
-        j = attrs['SOUTH-NORTH_GRID_DIMENSION'] - 1
-
-        # calculate attrs for area definition
-        shape = (j, i)
-        radius = (i*attrs['DX']/2, j*attrs['DY']/2)
+        # statistics of species are reported at the end
+        self.stats = stats_table()
         self.radius_of_influence = 200e3
+        self.index_meic()
+        self.proxies = self.check_proxies()
+        self.inventories = self.check_inventories()
+
+        # factors (species, kind) of scenarios, None is the base
+        self.scenarios = [(None, np.ones((len(self.names), self.nkind)))]
+        if scenario_file is not None:
+            for name, scenario in load_scenarios(scenario_file).items():
+                self.scenarios.append((name, scenario_factors(scenario,
+                                                              self.names,
+                                                              self.sectors,
+                                                              self.groups)))
+
+        # WRF areas of all domains
+        infos = {domain: get_info(data_path, domain) for domain in domains}
+        self.crop_grid([area_def for _, area_def in infos.values()])
+
+        # check hashes of the output files,
+        #   then just the changed species are read and resampled
+        jobs = [self.check_domain(domain, *infos[domain], st, et, delta)
+                for domain in domains]
+        stale = {name for job in jobs for output in job[3] for name in output['stale']}
+        self.read_meic([name for name in self.names if name in stale])
+        self.layers = self.read_inventories([area_def for _, area_def in infos.values()])
+
+        # the statistics collected in processes are returned
+        #   and merged in the order of domains
+        nrows = len(self.stats.rows)
+        results = map_jobs(self.process_domain, jobs, nprocs_domain)
+        self.stats.rows = self.stats.rows[:nrows] + \
+            [row for rows in results for row in rows]
+
+        self.stats.log()
+        logging.info('----- Successfully -----')
+
+    def check_domain(self, domain, geo, area_def, st, et, delta):
+        '''
+        Get the hashes of species in output files of each day
+            return: domain, geo Dataset, AreaDefinition, outputs
+        '''
+        orig_def = SwathDefinition(lons=self.emi['longitude'],
+                                   lats=self.emi['latitude'])
+        domain_hash = calc_hash(weights_hash(orig_def,
+                                             geo.attrs,
+                                             weights_method,
+                                             self.radius_of_influence,
+                                             bounds=(self.emi_lon_b, self.emi_lat_b)),
+                                sorted(geo.attrs.items()))
+        if self.proxies:
+            domain_hash = calc_hash(domain_hash,
+                                    *[(sector, file_hash(filename.format(domain=domain)), varname)
+                                      for sector, (filename, varname) in self.proxies.items()])
+        if self.inventories:
+            domain_hash = calc_hash(domain_hash,
+                                    resample_method,
+                                    *[(name, config['reader'], config['priority'],
+                                       config['settings'],
+                                       [file_hash(filename) for filename in config['files']],
+                                       [(file_hash(filename.format(domain=domain)), varname)
+                                        for filename, varname in config['rasters']])
+                                      for name, config in self.inventories.items()])
+
+        outputs = []
+        for day, (scenario, scale) in product(perdelta(st, et, timedelta(days=1)),
+                                              self.scenarios):
+            chemi_dir = output_dir
+            if scenario is not None:
+                chemi_dir += scenario + '/'
+            if st.date() != et.date():
+                chemi_dir += day.strftime('%Y%m%d') + '/'
+
+            # temporal factors of the day
+            end = day.replace(hour=maxhour)
+            Times = get_times(day, end, delta).values
+            times = list(perdelta(day, end, timedelta(hours=delta)))
+            factors = temporal_factors(times, self.nkind, month=mm).astype(emi_dtype)
+
+            day_hash = calc_hash(domain_hash, Times, factors, self.profile)
+            hashes = {name: calc_hash(self.hashes[name], day_hash, scale[index])
+                      for index, name in enumerate(self.names)}
+
+            filenames = [chemi_dir+f'wrfchemi_00z_{domain}',
+                         chemi_dir+f'wrfchemi_12z_{domain}']
+            manifest = manifest_name(chemi_dir, domain)
+            if incremental:
+                prev_hashes = load_manifest(manifest, filenames)
+            else:
+                prev_hashes = {}
+            stale = [name for name in self.names
+                     if prev_hashes.get(name) != hashes[name]]
+            logging.info(f'{len(stale)} of {len(self.names)} species '
+                         f'need to be updated in {filenames}')
+
+            outputs.append({'st': day,
+                            'scenario': scenario,
+                            'scale': scale,
+                            'Times': Times,
+                            'factors': factors,
+                            'filenames': filenames,
+                            'manifest': manifest,
+                            'hashes': hashes,
+                            'prev_hashes': prev_hashes,
+                            'stale': stale})
+
+        return domain, geo, area_def, outputs
+
+    def process_domain(self, job):
+        '''
+        Resample and save emissions of one domain
+            return: statistics of the domain
+        '''
+        domain, geo, area_def, outputs = job
+        if tile_size is not None:
+            return self.process_tiles(job)
+
+        nrows = len(self.stats.rows)
+        # emissions of any day in the month are same except weekly factors,
+        #   so the emissions of each sector are just resampled once
+        if self.vnames:
+            wrf_emi = self.resample_WRF(geo, area_def, domain)
+        else:
+            wrf_emi = None
+
+        if check_budget and self.vnames:
+            totals = budget_totals([self.emi[vname].values for vname in self.vnames],
+                                   self.emi_lon_b,
+                                   self.emi_lat_b,
+                                   self.emi_area,
+                                   wrf_emi,
+                                   area_def)
+
+            for output in outputs:
+                if output['scenario'] is None:
+                    report_budget(f'{domain} {output["st"]:%Y%m%d}',
+                                  self.vnames, *totals, output['factors'], budget_tol)
+
+        if self.layers and self.vnames:
+            self.blend_inventories(wrf_emi, geo, area_def, domain)
+
+        # apply temporal factors (and scenario) of each day and save,
+        #   the resampled emissions are shared by processes once
+        results = map_jobs(self.write_output,
+                           [(domain, geo.attrs, area_def.shape, output) for output in outputs],
+                           nprocs_output,
+                           initializer=init_shared,
+                           initargs=({'wrf_emi': wrf_emi},))
+        shared.clear()
+        self.stats.rows = self.stats.rows[:nrows] + \
+            [row for rows in results for row in rows]
+
+        return self.stats.rows[nrows:]
+
+    def process_tiles(self, job):
+        '''
+        Resample and save emissions of one domain tile by tile,
+            each tile is written to all files of the domain
+            return: statistics of the domain
+        '''
+        domain, geo, area_def, outputs = job
+        nrows = len(self.stats.rows)
+        tiles = split_tiles(area_def.shape, tile_size)
+        logging.info(f'Split {domain} {area_def.shape} into {len(tiles)} tiles')
+
+        # open the files which need to be updated
+        files = [(output, self.open_output(output, geo.attrs, area_def.shape))
+                 for output in outputs]
+        files = [(output, opened) for output, opened in files if opened is not None]
+
+        if self.vnames and files:
+            # the emission grid is shared by processes once
+            emi_stack = self.emi[self.vnames].to_array().values
+            logging.info(f'Resample {", ".join(self.vnames)} ...')
+            results = resample_tiles(emi_stack,
+                                     self.grid(),
+                                     area_def,
+                                     geo.attrs,
+                                     weights_method,
+                                     self.radius_of_influence,
+                                     tiles,
+                                     cache_dir=cache_dir,
+                                     nprocs=nprocs_tile)
+        else:
+            emi_stack = None
+            results = ((tile, None) for tile in tiles)
+
+        # totals after resampling are summed over tiles
+        after = 0
+        for tile, tile_emi in results:
+            for output, (writer, prev_files) in files:
+                self.write_species(output, domain, writer, prev_files,
+                                   tile_emi, tile=tile)
+            if check_budget and tile_emi is not None:
+                after += wrf_totals(tile_emi, tile_area_def(area_def, tile), memoize=False)
+
+        for output, (writer, prev_files) in files:
+            self.close_output(output, writer, prev_files)
+
+        if check_budget and emi_stack is not None:
+            before = emission_totals([self.emi[vname].values for vname in self.vnames],
+                                     self.emi_lon_b,
+                                     self.emi_lat_b,
+                                     self.emi_area,
+                                     area_def)
+            for output, _ in files:
+                if output['scenario'] is None:
+                    report_budget(f'{domain} {output["st"]:%Y%m%d}',
+                                  self.vnames, before, after, output['factors'], budget_tol)
+
+        return self.stats.rows[nrows:]
+
+    def write_output(self, job):
+        '''
+        Save files of one day and scenario
+            return: statistics of the files
+        '''
+        domain, attrs, shape, output = job
+        nrows = len(self.stats.rows)
+        self.create_file(output, domain, attrs, shape, shared['wrf_emi'])
+
+        return self.stats.rows[nrows:]
 
-        # create area as same as WRF
-        area_id = 'wrf_circle'
-        proj_dict = {'proj': wrf_projs[attrs['MAP_PROJ']],
-                     'lat_0': attrs['CEN_LAT'],
-                     'lon_0': attrs['CEN_LON'],
-                     'lat_1': attrs['TRUELAT1'],
-                     'lat_2': attrs['TRUELAT2'],
-                     'a': 6370000,
-                     'b': 6370000}
-        center = (0, 0)
-        self.area_def = AreaDefinition.from_circle(area_id,
-                                                   proj_dict,
-                                                   center,
-                                                   radius,
-                                                   shape=shape)
-        logging.info(f'Area: {self.area_def}')
-
-    def read_meic(self, ):
+    def index_meic(self, ):
+        '''
+        Compile the conversion table, index MEIC files
+            and get the hash of inputs of each species
+        '''
+        # compile conversion table into the speciation matrix
+        df = read_table('./conversion_table.csv')
+        self.names, units, self.keys, self.matrix = compile_table(df, days)
+        self.units = dict(zip(self.names, units))
+
+        # index the MEIC files of all mechanisms once
+        emi_path = data_path+str(yyyy_emi)+'/'
+        self.files = index_files(emi_path, df.columns[1:-5])
+        grid = read_grid(self.files[self.keys[0]][0])
+        self.nkind = len(self.files[self.keys[0]])
+        self.sectors = [sector_name(file).upper() for file in self.files[self.keys[0]]]
+        self.groups = species_groups(df, self.names)
+        # vertical profiles (nz, kind)
+        self.profile = load_vertical(self.nkind)
+        self.calc_area(grid)
+        self.vnames = []
+
+        # row of conversion table and content of files
+        logging.info('Hashing MEIC files ...')
+        self.hashes = {}
+        for index, name in enumerate(self.names):
+            row = self.matrix[index]
+            keys = [self.keys[j] for j in row.indices]
+            self.hashes[name] = calc_hash(self.var_names(name),
+                                          self.units[name], keys, row.data,
+                                          [file_hash(file) for key in keys
+                                           for file in self.files.get(key, [])])
+
+    def var_names(self, name):
+        '''Names of the total and sectors (if sector_tags) of species'''
+        if sector_tags:
+            return [name] + [f'{name}_{sector}' for sector in self.sectors]
+        else:
+            return [name]
+
+    def read_meic(self, names):
         '''
         Read MEIC data of different mechanisms
             and convert to species in MOZART
         '''
-        # read conversion table
-        df = pd.read_csv('./conversion_table.csv',
-                         sep=' *, *',  # delete spaces
-                         comment='#',
-                         engine="python",
-                         dtype=conversion_table_dtype)
-
-        # iterate through MEIC mechanisms
-        for col in df.columns[1:-4]:
-            logging.info('Reading '+col+' mechanism .....')
-            if col == 'ALL':
-                # choose any col name
-                col_path = df.columns[1]
-            else:
-                col_path = col
-            emi_path = data_path+str(yyyy_emi)+'/'+col_path+'/'
-            # drop nan values and don't reset index
-            #   we need the index in other variables
-            species = df[col].dropna()
-
-            for index, spec in enumerate(species):
-                # get variables related to desired chemical mechanism
-                name = df[df.columns[0]][species.index[index]]
-                weight = df['WEIGHT'][species.index[index]]
-                mw = df['MW'][species.index[index]]
-                solid = df['SOLID'][species.index[index]]
-                voc = df['VOC'][species.index[index]]
-
-                logging.info(' '*8+'Map to '+name+' species')
-                emi_exist = hasattr(self, 'emi')
-
-                for index_s, s in enumerate(spec.split('+')):
-                    logging.info(' '*10+'Reading '+s+' species ....')
-                    pattern = emi_path+'*_'+s+'.nc'
-                    # len of filelist should be 5 in sequence:
-                    #   agriculture, industry, power,
-                    #   residential and transportation
-                    files = sorted(glob(pattern))
-                    # sum all sources for the specific species
-                    ds = xr.open_mfdataset(files,
-                                           concat_dim='kind',
-                                           combine='nested')
-
-                    if not emi_exist:
-                        # just read lon/lat once
-                        self.calc_area(ds)
-                        self.emi = self.get_ds(ds, name, weight,
-                                               solid, mw, voc)
-                    else:
-                        if len(spec) > 1 and index_s > 0:
-                            # like spec_a+spec_b+...
-                            self.emi[name] += self.get_ds(ds, name,
-                                                          weight, solid,
-                                                          mw, voc)[name]
-                        else:
-                            self.emi[name] = self.get_ds(ds, name,
-                                                         weight, solid,
-                                                         mw, voc)[name]
-
-                logging.debug(' '*8 +
-                              ' min: ' + str(self.emi[name].min().values) +
-                              ' max: ' + str(self.emi[name].max().values) +
-                              ' mean ' + str(self.emi[name].mean().values)
-                              )
-
-    def calc_area(self, ds):
+        if not names:
+            logging.info('All species are up to date')
+            return
+
+        # the speciation matrix of species to be updated
+        matrix = self.matrix[[self.names.index(name) for name in names]]
+        cols = np.unique(matrix.indices)
+        keys = [self.keys[j] for j in cols]
+        matrix = matrix[:, cols]
+
+        # read each (sector, species) file just once
+        #   len of kind should be 5 in sequence:
+        #   agriculture, industry, power,
+        #   residential and transportation
+        logging.info(f'Reading {len(keys)} MEIC species .....')
+        cube, grid = read_cube(self.files, keys,
+                               dtype=emi_dtype, window=self.window, nprocs=nprocs)
+
+        # map all species and sectors in one product
+        logging.info(f'Mapping to {len(names)} species ...')
+        emi = apply_speciation(matrix, cube, self.emi_area)
+        del cube
+
+        # save in the order of conversion table
+        for index, name in enumerate(names):
+            self.emi[name] = xr.DataArray(emi[index],
+                                          dims=['kind', 'y', 'x'],
+                                          attrs={'units': self.units[name]})
+            self.stats.add('MEIC', name, emi[index])
+        self.vnames = names
+
+    def calc_area(self, grid):
         '''
         Get the lon/lat and area (m2)of emission gridded data
         '''
-        ds = ds.isel(kind=0)
-        self.emi_lon_b = np.arange(ds['x_range'][0],
-                                   ds['x_range'][1]+ds['spacing'][0],
-                                   ds['spacing'][0])
-        self.emi_lat_b = np.arange(ds['y_range'][0],
-                                   ds['y_range'][1]+ds['spacing'][1],
-                                   ds['spacing'][1])
+        self.emi_lon_b = np.arange(grid['x_range'][0],
+                                   grid['x_range'][1]+grid['spacing'][0],
+                                   grid['spacing'][0])
+        self.emi_lat_b = np.arange(grid['y_range'][0],
+                                   grid['y_range'][1]+grid['spacing'][1],
+                                   grid['spacing'][1])
         self.emi_lon = (self.emi_lon_b[:-1] + self.emi_lon_b[1:])/2
         self.emi_lat = (self.emi_lat_b[:-1] + self.emi_lat_b[1:])/2
 
-        # ref: https://github.com/Timothy-W-Hilton/STEMPyTools
-        lon_bounds2d, lat_bounds2d = np.meshgrid(self.emi_lon_b, self.emi_lat_b)
-        EARTH_RADIUS = 6370000.0
-        Rad_per_Deg = np.pi / 180.0
-
-        ydim = lon_bounds2d.shape[0]-1
-        xdim = lon_bounds2d.shape[1]-1
-        area = np.full((ydim, xdim), np.nan)
-        for j in range(ydim):
-            for i in range(xdim):
-                xlon1 = lon_bounds2d[j, i]
-                xlon2 = lon_bounds2d[j, i+1]
-                ylat1 = lat_bounds2d[j, i]
-                ylat2 = lat_bounds2d[j+1, i]
-
-                cap_ht = EARTH_RADIUS * (1 - np.sin(ylat1 * Rad_per_Deg))
-                cap1_area = 2 * np.pi * EARTH_RADIUS * cap_ht
-                cap_ht = EARTH_RADIUS * (1 - np.sin(ylat2 * Rad_per_Deg))
-                cap2_area = 2 * np.pi * EARTH_RADIUS * cap_ht
-                area[j, i] = abs(cap1_area - cap2_area) * abs(xlon1 - xlon2) / 360.0
-
-        self.emi_area = area
-
-    def get_ds(self, ds, name, weight, solid, mw, voc):
-        '''
-        Generate the reshaped ds for species
-        '''
-        seconds = days*24*3600
-        hours = days*24
-        # z is the emission of species
-        # shape: 5*64000 (kind*grid)
-        valid = ds.z != ds.z.attrs['nodata_value']
-        if solid:
-            # WRF-Chem unit: ug/m3 m/s
-            # MEIC: unit: tg/(grid*month)
-            ds['z'] = ds['z'].where(valid, 0.) * weight*1e12 \
-                      / (seconds * np.tile(self.emi_area.ravel(),
-                                           (ds['z'].shape[0], 1)
-                                           )
-                         )
-            ds['z'].attrs['units'] = 'ug/m3 m/s'
-        elif voc:
-            # WRF-Chem unit: mol km-2 hr-1
-            # MEIC unit: 10**6 mol/(grid*month)
-            ds['z'] = ds['z'].where(valid, 0.) * weight*1e6 \
-                      / (hours*np.tile(self.emi_area.ravel()/1e6,
-                                       (ds['z'].shape[0], 1)
-                                       )
-                         )
-            ds['z'].attrs['units'] = 'mol km^-2 hr^-1'
+        # the area is read from cache if the grid has been used
+        if save_area:
+            cache_dir = data_path+str(yyyy_emi)+'/'
         else:
-            # WRF-Chem unit: mol km-2 hr-1
-            # MEIC unit: tg/(grid*month)
-            ds['z'] = ds['z'].where(valid, 0.) * weight*1e6 \
-                      / (hours*mw*np.tile(self.emi_area.ravel()/1e6,
-                                          (ds['z'].shape[0], 1)
-                                          )
-                         )
-            ds['z'].attrs['units'] = 'mol km^-2 hr^-1'
-
-        # read hourly factor table
-        try:
-            # shape: 24*5 (time*kind)
-            table = xr.DataArray(np.genfromtxt('./hourly_factor.csv',
-                                               delimiter=',',
-                                               comments='#',
-                                               usecols=(0, 1, 2, 3, 4),
-                                               skip_header=2),
-                                 dims=['time', 'kind']
-                                 )
-            table = table/(table.sum(dim='time')/24)
-
-        except OSError:
-            logging.info(' '*8 +
-                         'hourly_factor.csv does not exist, use 1 instead')
-            table = xr.DataArray(np.full((24, 5), 1),
-                                 dims=['time', 'kind'])
-
-        # use einsum in xarray to create the hourly emissions
-        # https://stackoverflow.com/questions/26089893/understanding-numpys-einsum
-        # (24*5) .* (5*64000) = 24* 64000 (time*grid)
-        dims = ds['dimension'].values
-        ydim = dims[0, 1]
-        xdim = dims[0, 0]
-        # we need to flip because of the "strange" order
-        #   of 1d array in MEIC nc file.
-        ds[name] = xr.DataArray(np.flip(table.dot(ds['z']).values.reshape((-1, ydim, xdim)), (1)),
-                                dims=['time', 'y', 'x'],
-                                attrs=ds['z'].attrs
-                                )
-
-        # drop old dims
-        ds = ds.drop_dims(['xysize', 'side', 'kind'])
-        # create new variables
+            cache_dir = None
+        self.emi_area = get_grid_area(self.emi_lon_b, self.emi_lat_b,
+                                      cache_dir=cache_dir)
+
+    def crop_grid(self, area_defs):
+        '''
+        Crop the grid to the box of domains plus radius_of_influence
+            and create the Dataset with lon/lat of cropped grid
+        '''
+        if crop:
+            bbox = domain_bbox(area_defs, self.radius_of_influence)
+            self.window = crop_window(self.emi_lon_b, self.emi_lat_b, bbox)
+        else:
+            self.window = (slice(0, len(self.emi_lat)), slice(0, len(self.emi_lon)))
+
+        y, x = self.window
+        self.emi_lon_b = self.emi_lon_b[x.start:x.stop+1]
+        self.emi_lat_b = self.emi_lat_b[y.start:y.stop+1]
+        self.emi_lon = self.emi_lon[x]
+        self.emi_lat = self.emi_lat[y]
+        self.emi_area = self.emi_area[y, x]
+
         lon2d, lat2d = np.meshgrid(self.emi_lon, self.emi_lat)
-        lon_bounds2d, lat_bounds2d = np.meshgrid(self.emi_lon_b, self.emi_lat_b)
-
-        # assign to ds
-        ds['longitude'] = xr.DataArray(lon2d,
-                                       coords=[self.emi_lat, self.emi_lon],
-                                       dims=['y', 'x'])
-        ds['latitude'] = xr.DataArray(lat2d,
-                                      coords=[self.emi_lat, self.emi_lon],
-                                      dims=['y', 'x'])
-
-        ds.attrs.pop('title')
-
-        return ds
-
-    def perdelta(self, start, end, delta):
-        '''
-        Generate the 24-h datetime list
-        '''
-        curr = start
-        while curr <= end:
-            yield curr
-            curr += delta
-
-    def resample_WRF(self, st, et, delta):
-        '''
-        Create Times variable and resample emission species DataArray.
-        '''
-        # generate date every hour
-        datetime_list = list(self.perdelta(st, et, timedelta(hours=1)))
-        t_format = '%Y-%m-%d_%H:%M:%S'
-        # convert datetime to date string
-        Times = []
-        for timstep in datetime_list:
-            times_str = strftime(t_format, timstep.timetuple())
-            Times.append(times_str)
-        # the method of creating "Times" with unlimited dimension
-        # ref: htttps://github.com/pydata/xarray/issues/3407
-        Times = xr.DataArray(np.array(Times,
-                                      dtype=np.dtype(('S', 19))
-                                      ),
-                             dims=['Time'])
-        self.chemi = xr.Dataset({'Times': Times})
-
-        # resample
+        self.emi = xr.Dataset({'longitude': (['y', 'x'], lon2d),
+                               'latitude': (['y', 'x'], lat2d)},
+                              coords={'y': self.emi_lat, 'x': self.emi_lon})
+
+    def check_proxies(self, ):
+        '''
+        Check the proxy rasters of sectors
+            return: {SECTOR: (filename, variable)}
+        '''
+        proxies = {sector.upper(): proxy for sector, proxy in proxy_files.items()}
+        unknown = set(proxies) - set(self.sectors)
+        if unknown:
+            raise ValueError(f'Unknown sectors of proxy_files: {unknown}, '
+                             f'choose from {self.sectors}')
+        if proxies and tile_size is not None:
+            raise ValueError('proxy_files is not supported with tile_size, '
+                             'because each MEIC cell is normalized over the whole domain')
+
+        return proxies
+
+    def check_inventories(self, ):
+        '''
+        Check the readers of inventories
+            return: {name: {'reader': name of module, 'priority', 'mask',
+                            'files': input files, 'settings': settings of the reader,
+                            'rasters': [(filename, variable)]}}
+            just the name of module is kept, because self is sent to processes
+        '''
+        if inventories and tile_size is not None:
+            raise ValueError('inventories is not supported with tile_size')
+
+        checked = {}
+        for name, config in inventories.items():
+            reader = importlib.import_module(config['reader'])
+            priority = config.get('priority', 1)
+            settings = reader.inventory_settings()
+            rasters = [raster for raster in (config.get('mask'), priority)
+                       if isinstance(raster, tuple)]
+            checked[name] = {'reader': config['reader'],
+                             'priority': priority,
+                             'mask': config.get('mask'),
+                             'files': reader.inventory_files(),
+                             'settings': sorted(settings.items()),
+                             'rasters': rasters}
+
+        return checked
+
+    def read_inventories(self, area_defs):
+        '''
+        Read the inventories once for all domains
+            return: {name: dict of blend.py with the species in MEIC}
+        '''
+        layers = {}
+        if not self.vnames:
+            return layers
+
+        for name, config in self.inventories.items():
+            logging.info(f'Reading {name} inventory ...')
+            reader = importlib.import_module(config['reader'])
+            inventory = reader.read_inventory(area_defs, yyyy, mm)
+            skipped = [vname for vname in inventory['emi'] if vname not in self.names]
+            if skipped:
+                logging.warning(' '*8 + f'{", ".join(skipped)} of {name} '
+                                'are not in MEIC and skipped')
+            for vname in inventory['emi']:
+                if vname in self.vnames and not same_units(inventory['units'][vname],
+                                                           self.units[vname]):
+                    raise ValueError(f'Units of {vname} in {name} ({inventory["units"][vname]}) '
+                                     f'are different from MEIC ({self.units[vname]})')
+            inventory['emi'] = {vname: values for vname, values in inventory['emi'].items()
+                                if vname in self.vnames}
+            for vname, values in inventory['emi'].items():
+                self.stats.add(name, vname, values)
+            layers[name] = inventory
+
+        return layers
+
+    def blend_inventories(self, wrf_emi, geo, area_def, domain):
+        '''
+        Resample the inventories and blend them
+            with the resampled MEIC (wrf_emi) in place
+        '''
+        layers = [{'name': 'MEIC',
+                   'names': self.vnames,
+                   'emi': wrf_emi,
+                   'mask': np.ones(area_def.shape),
+                   'priority': np.zeros(area_def.shape)}]
+
+        for name, inventory in self.layers.items():
+            names = list(inventory['emi'])
+            if not names:
+                continue
+            logging.info(f'Resample {", ".join(names)} of {name} ...')
+            # stack all species and kinds: (species*kind, y, x),
+            #   the last field is the coverage of the inventory grid
+            emi = np.stack([inventory['emi'][vname] for vname in names]).astype(emi_dtype)
+            emi = np.concatenate([emi.reshape((-1,) + emi.shape[-2:]),
+                                  np.ones((1,) + emi.shape[-2:], dtype=emi_dtype)])
+            resampled = resample_grid(emi,
+                                      inventory['lon'],
+                                      inventory['lat'],
+                                      inventory['lon_b'],
+                                      inventory['lat_b'],
+                                      area_def,
+                                      geo.attrs,
+                                      resample_method,
+                                      self.radius_of_influence,
+                                      cache_dir=cache_dir)
+
+            config = self.inventories[name]
+            mask = resampled[-1].astype(np.float64)
+            if config['mask'] is not None:
+                filename, varname = config['mask']
+                mask *= read_raster(filename.format(domain=domain),
+                                    varname, area_def, geo.attrs, cache_dir=cache_dir)
+            priority = config['priority']
+            if isinstance(priority, tuple):
+                filename, varname = priority
+                priority = read_raster(filename.format(domain=domain),
+                                       varname, area_def, geo.attrs, cache_dir=cache_dir)
+
+            layers.append({'name': name,
+                           'names': names,
+                           'emi': resampled[:-1].reshape((len(names), -1) + area_def.shape),
+                           'mask': mask,
+                           'priority': np.broadcast_to(priority, area_def.shape)})
+
+        blend_layers(layers, self.vnames, wrf_emi)
+
+    def resample_WRF(self, geo, area_def, domain):
+        '''
+        Resample emission species DataArray of all sectors.
+            return: array (species, kind, south_north, west_east)
+        '''
+        # stack all species: (species, kind, y, x)
+        logging.info(f'Resample {", ".join(self.vnames)} ...')
+        emi_stack = self.emi[self.vnames].to_array().values
+
+        if not self.proxies:
+            return resample_domain(emi_stack,
+                                   self.grid(),
+                                   area_def,
+                                   geo.attrs,
+                                   weights_method,
+                                   self.radius_of_influence,
+                                   cache_dir=cache_dir,
+                                   nprocs=nprocs)
+
+        # the conservative weights are shared by all sectors
         orig_def = SwathDefinition(lons=self.emi['longitude'],
                                    lats=self.emi['latitude'])
-        for vname in self.emi.data_vars:
-            if 'E_' in vname:
-                logging.info(f'Resample {vname} ...')
-                resampled_list = []
-                for t in range(self.emi[vname].shape[0]):
-                    # different resample methods
-                    # see: http://earthpy.org/interpolation_between_grids_with_pyresample.html
-                    if resample_method == 'nearest':
-                        resampled_list.append(resample_nearest(
-                                              orig_def,
-                                              self.emi[vname][t, :, :].values,
-                                              self.area_def,
-                                              radius_of_influence=self.radius_of_influence,
-                                              fill_value=0.)
-                                              )
-                    elif resample_method == 'idw':
-                        resampled_list.append(resample_custom(
-                                              orig_def,
-                                              self.emi[vname][t, :, :].values,
-                                              self.area_def,
-                                              radius_of_influence=self.radius_of_influence,
-                                              neighbours=10,
-                                              weight_funcs=lambda r: 1/r**2,
-                                              fill_value=0.)
-                                              )
-                    elif resample_method == 'bilinear':
-                        resampled_list.append(resample_bilinear(
-                                              self.emi[vname][t, :, :].values,
-                                              orig_def,
-                                              self.area_def,
-                                              radius=self.radius_of_influence,
-                                              neighbours=10,
-                                              nprocs=4,
-                                              reduce_data=True,
-                                              segments=None,
-                                              fill_value=0.,
-                                              epsilon=0)
-                                              )
-                # combine 2d array list to one 3d
-                # ref: https://stackoverflow.com/questions/4341359/
-                #       convert-a-list-of-2d-numpy-arrays-to-one-3d-numpy-array
-                # we also need to flip the 3d array,
-                #    because of the "strange" order of 1d array in MEIC nc file
-                #    then add another dimension for zdim.
-                resampled_data = np.flip(np.rollaxis(np.dstack(resampled_list), -1), 1)[:, np.newaxis, ...]
-                # assign to self.chemi with dims
-                self.chemi[vname] = xr.DataArray(resampled_data,
-                                                 dims=['Time',
-                                                       'emissions_zdim',
-                                                       'south_north',
-                                                       'west_east'
-                                                       ]
-                                                 )
-
-                # add attrs needed by WRF-Chem
-                v_attrs = {'FieldType': 104,
-                           'MemoryOrder': 'XYZ',
-                           'description': vname,
-                           'stagger': '',
-                           'coordinates': 'XLONG XLAT',
-                           'units': self.emi[vname].attrs['units']
-                           }
-
-                self.chemi[vname] = self.chemi[vname].assign_attrs(v_attrs)
-
-                logging.debug(' '*8 +
-                              ' min: ' + str(self.chemi[vname].min().values) +
-                              ' max: ' + str(self.chemi[vname].max().values) +
-                              ' mean ' + str(self.chemi[vname].mean().values)
-                              )
-
-    def create_file(self, ):
+        weights = get_weights(orig_def,
+                              area_def,
+                              geo.attrs,
+                              weights_method,
+                              self.radius_of_influence,
+                              cache_dir=cache_dir,
+                              bounds=(self.emi_lon_b, self.emi_lat_b))
+
+        # rows of WRF start from the south
+        weights = to_wrf_order(weights, area_def.shape)
+
+        # resample the whole stack into the preallocated array
+        #   with dims (species, kind, south_north, west_east)
+        wrf_emi = np.empty(emi_stack.shape[:2] + area_def.shape, dtype=emi_dtype)
+        # one operator of each sector: (species, y, x) -> (species, south_north, west_east)
+        for k, sector in enumerate(self.sectors):
+            if sector in self.proxies:
+                filename, varname = self.proxies[sector]
+                proxy = read_raster(filename.format(domain=domain),
+                                    varname,
+                                    area_def,
+                                    geo.attrs,
+                                    cache_dir=cache_dir)
+                operator = proxy_operator(weights, proxy)
+            else:
+                operator = weights
+            # the product keeps the precision of emissions
+            apply_weights(operator.astype(emi_dtype),
+                          emi_stack[:, k],
+                          area_def.shape,
+                          out=wrf_emi[:, k])
+        del emi_stack
+
+        return wrf_emi
+
+    def grid(self, ):
+        '''Regular grid of the cropped MEIC (see domain.py)'''
+        return {'lon': self.emi_lon,
+                'lat': self.emi_lat,
+                'lon_b': self.emi_lon_b,
+                'lat_b': self.emi_lat_b}
+
+    def create_file(self, output, domain, attrs, shape, wrf_emi):
         '''
         Create two wrfchemi* files:
             wrfchemi_00z_d<n> and wrfchemi_12z_d<n>
+            and write species one by one after applying temporal factors
+            the species which are not changed are copied from previous files
         '''
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
-        comp = dict(zlib=True, complevel=5)
-        comp_t = dict(zlib=True, complevel=5, char_dim_name='DateStrLen')
-        encoding = {var: comp_t if var == 'Times' else comp
-                    for var in self.chemi.data_vars}
-
-        logging.info(f'Saving to {output_dir}wrfchemi_00z_{domain}')
-        chemi_00 = self.chemi.isel(Time=np.arange(12)).assign_attrs(self.geo.attrs)
-        chemi_00.to_netcdf(
-                            output_dir+f'wrfchemi_00z_{domain}',
-                            format='NETCDF4',
-                            encoding=encoding,
-                            unlimited_dims={'Time': True}
-                          )
-
-        logging.info(f'Saving to {output_dir}wrfchemi_12z_{domain}')
-        chemi_12 = self.chemi.isel(Time=np.arange(12, 24, 1)).assign_attrs(self.geo.attrs)
-        chemi_12.to_netcdf(
-                            output_dir+f'wrfchemi_12z_{domain}',
-                            format='NETCDF4',
-                            encoding=encoding,
-                            unlimited_dims={'Time': True}
-                          )
+        opened = self.open_output(output, attrs, shape)
+        if opened is None:
+            return
 
-        logging.info('----- Successfully -----')
+        writer, prev_files = opened
+        self.write_species(output, domain, writer, prev_files, wrf_emi)
+        self.close_output(output, writer, prev_files)
+
+    def open_output(self, output, attrs, shape):
+        '''
+        Open the temporary files and the previous files
+            return: chemi_writer, previous Datasets
+                or None if the files are up to date
+        '''
+        filenames = output['filenames']
+        stale = output['stale']
+        if not stale and list(output['prev_hashes']) == self.names:
+            logging.info(f'{filenames} are up to date')
+            return None
+
+        # the previous files are kept until the new files are finished
+        remove_manifest(output['manifest'])
+        tmp_files = [filename+'.tmp' for filename in filenames]
+        if len(stale) < len(self.names):
+            prev_files = [Dataset(filename) for filename in filenames]
+            for nc in prev_files:
+                nc.set_auto_mask(False)
+        else:
+            prev_files = []
+
+        writer = chemi_writer(tmp_files,
+                              output['Times'],
+                              shape,
+                              attrs,
+                              nz=self.profile.shape[0],
+                              tile_size=tile_size)
+
+        return writer, prev_files
+
+    def write_species(self, output, domain, writer, prev_files, wrf_emi, tile=None):
+        '''
+        Write species of the whole domain or one tile
+            wrf_emi: (species, kind, south_north, west_east) of the domain or tile
+            tile: (slice of south_north, slice of west_east), None: the whole domain
+        '''
+        stale = output['stale']
+        if tile is None:
+            shape = writer.shape
+            hyperslab = (slice(None),) * 4
+        else:
+            shape = (tile[0].stop-tile[0].start, tile[1].stop-tile[1].start)
+            hyperslab = (slice(None), slice(None)) + tile
+        label = ' '.join(filter(None, [domain,
+                                       f'{output["st"]:%Y%m%d}',
+                                       output['scenario']]))
+
+        # one array (Time, emissions_zdim, south_north, west_east) for all species
+        nz = self.profile.shape[0]
+        chemi_data = np.empty((len(output['Times']), nz) + shape, dtype=emi_dtype)
+
+        for vname in self.names:
+            if vname in stale:
+                index = self.vnames.index(vname)
+                # temporal factors * factors of scenario * vertical factors
+                #   with dims (time, level, kind)
+                factors = vertical_factors(output['factors'] *
+                                           output['scale'][self.names.index(vname)],
+                                           self.profile).astype(emi_dtype)
+            for k, tag in enumerate(self.var_names(vname)):
+                if vname not in stale:
+                    logging.debug(' '*8 + f'Copy {tag} from previous files')
+                    np.concatenate([nc.variables[tag][hyperslab] for nc in prev_files],
+                                   out=chemi_data)
+                elif k == 0:
+                    # ((time*level)*kind) .* (kind*grid) = (time*level)*grid
+                    apply_factors(factors.reshape(-1, self.nkind),
+                                  wrf_emi[index:index+1],
+                                  out=chemi_data.reshape((1, -1) + shape))
+                else:
+                    # sector k-1: (time*level) .* (grid) = time*level*grid
+                    np.multiply(factors[:, :, k-1, np.newaxis, np.newaxis],
+                                wrf_emi[index, k-1],
+                                out=chemi_data)
+                writer.write(tag,
+                             chemi_data,
+                             chemi_attrs(tag, self.units[vname]),
+                             dtype=emi_dtype,
+                             index=tile)
+                # statistics of tiles are merged
+                self.stats.add(label, tag, chemi_data, merge=tile is not None)
+
+    def close_output(self, output, writer, prev_files):
+        '''Replace the previous files by the finished files'''
+        writer.close()
+        for nc in prev_files:
+            nc.close()
+        for tmp_file, filename in zip(writer.filenames, output['filenames']):
+            os.replace(tmp_file, filename)
+        save_manifest(output['manifest'], output['hashes'])
 
 
 if __name__ == '__main__':
     st = datetime(yyyy, mm, dd, minhour)
-    et = datetime(yyyy, mm, dd, maxhour)
+    et = datetime(yyyy, mm, dd_end, maxhour)
     meic(st, et, delta)
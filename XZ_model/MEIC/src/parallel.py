@@ -0,0 +1,64 @@
+'''
+Run jobs in a process pool
+
+The results are always returned in the order of jobs,
+    so the output is same as the serial run.
+'''
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# data shared by the workers, set once for each worker by init_shared
+shared = {}
+
+
+def map_jobs(func, jobs, nprocs=1, initializer=None, initargs=()):
+    '''
+    Apply func to each job
+        nprocs > 1: use a process pool with nprocs workers
+        nprocs = 1: run serially in this process
+    '''
+    jobs = list(jobs)
+    if nprocs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(nprocs, len(jobs)),
+                                 initializer=initializer,
+                                 initargs=initargs) as pool:
+            return list(pool.map(func, jobs))
+
+    if initializer is not None:
+        initializer(*initargs)
+
+    return [func(job) for job in jobs]
+
+
+def imap_jobs(func, jobs, nprocs=1, initializer=None, initargs=()):
+    '''
+    Apply func to each job and yield the results in the order of jobs,
+        at most nprocs results are waiting to be used at the same time,
+        so the memory is bounded by nprocs jobs instead of all jobs
+    '''
+    jobs = list(jobs)
+    if nprocs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(nprocs, len(jobs)),
+                                 initializer=initializer,
+                                 initargs=initargs) as pool:
+            futures = deque()
+            for job in jobs:
+                futures.append(pool.submit(func, job))
+                if len(futures) >= nprocs:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        return
+
+    if initializer is not None:
+        initializer(*initargs)
+
+    for job in jobs:
+        yield func(job)
+
+
+def init_shared(data):
+    '''Set the data shared by all jobs, e.g. a large array'''
+    shared.clear()
+    shared.update(data)
@@ -0,0 +1,385 @@
+'''
+Resampling weights of emission grids to WRF area
+
+The neighbour info of pyresample (nearest, idw or bilinear)
+    or the overlap fractions of cells (conservative)
+    are converted to a sparse matrix (n_wrf_grid * n_emi_grid),
+    then resampling one 2d field is just a sparse mat-vec
+    and all fields (time, species, ...) are resampled in one product.
+
+The matrix is memoized and saved as weights_<hash>.npz in cache_dir,
+    the hash is generated by lon/lat of emission grid,
+    projection attrs of geo_em file, method and radius_of_influence.
+
+Conservative method (first-order):
+    The emission cells (lon/lat bounds) are projected to the WRF plane,
+    clipped by each WRF cell (Sutherland-Hodgman algorithm),
+    and the weight is the overlap area divided by the area of WRF cell.
+    So the emission rates (per area) keep the domain total.
+'''
+
+import hashlib
+import logging
+import os
+
+import numpy as np
+from pyresample.bilinear import get_bil_info
+from pyresample.kd_tree import get_neighbour_info
+from pyproj import Proj
+from pyresample.geometry import SwathDefinition
+from scipy import sparse
+
+from crop import crop_window, domain_bbox
+
+# attrs of geo_em file which define the WRF area
+proj_attrs = ['MAP_PROJ', 'CEN_LAT', 'CEN_LON',
+              'TRUELAT1', 'TRUELAT2', 'STAND_LON',
+              'DX', 'DY',
+              'WEST-EAST_GRID_DIMENSION',
+              'SOUTH-NORTH_GRID_DIMENSION']
+
+# memoized weights in this run
+_weights_cache = {}
+
+# weights shared by the workers of process pool
+_pool_weights = None
+_pool_shape = None
+
+
+def weights_hash(orig_def, geo_attrs, method, radius_of_influence,
+                 bounds=None, tile=None):
+    '''
+    Get the hash of resampling settings
+        tile: (slice of south_north, slice of west_east) of the WRF domain
+    '''
+    sha = hashlib.sha1()
+    lonlats = [orig_def.lons, orig_def.lats]
+    if bounds is not None:
+        lonlats.extend(bounds)
+    for lonlat in lonlats:
+        lonlat = np.ascontiguousarray(lonlat, dtype=np.float64)
+        sha.update(str(lonlat.shape).encode())
+        sha.update(lonlat.tobytes())
+    for key in proj_attrs:
+        if key in geo_attrs:
+            sha.update(f'{key}={float(geo_attrs[key])!r};'.encode())
+    sha.update(f'{method};{float(radius_of_influence)!r}'.encode())
+    if tile is not None:
+        sha.update(';'.join(f'{s.start}:{s.stop}' for s in tile).encode())
+
+    return sha.hexdigest()[:16]
+
+
+def calc_weights(orig_def, area_def, method, radius_of_influence,
+                 bounds=None):
+    '''
+    Calculate the sparse resampling matrix
+        shape: (area_def.size, orig_def.size)
+        the row order is same as the output of pyresample
+        bounds: (lon_b, lat_b) of emission grid, needed by conservative
+    '''
+    n_out = area_def.size
+    n_in = orig_def.size
+
+    if method == 'conservative':
+        if bounds is None:
+            raise ValueError('lon/lat bounds are needed by conservative method')
+        return calc_conservative_weights(*bounds, area_def)
+
+    elif method in ['nearest', 'idw']:
+        neighbours = 1 if method == 'nearest' else 10
+        valid_input_index, valid_output_index, index_array, distance_array = \
+            get_neighbour_info(orig_def,
+                               area_def,
+                               radius_of_influence,
+                               neighbours=neighbours)
+        index_array = index_array.reshape(index_array.shape[0], -1)
+        distance_array = distance_array.reshape(index_array.shape)
+        # neighbours not found are marked by the number of valid input
+        valid = index_array < valid_input_index.sum()
+
+        if method == 'nearest':
+            weights = np.ones(index_array.shape)
+        else:
+            # same as weight_funcs=lambda r: 1/r**2
+            weights = 1 / np.maximum(distance_array, 1e-6)**2
+            weights = np.where(valid, weights, 0.)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                weights /= weights.sum(axis=1, keepdims=True)
+
+    elif method == 'bilinear':
+        t__, s__, valid_input_index, index_array = \
+            get_bil_info(orig_def,
+                         area_def,
+                         radius=radius_of_influence,
+                         neighbours=10,
+                         nprocs=4,
+                         reduce_data=True,
+                         segments=None,
+                         epsilon=0)
+        if t__.size == n_out:
+            valid_output_index = np.ones(n_out, dtype=bool)
+        else:
+            lons, lats = area_def.get_lonlats()
+            valid_output_index = np.ravel((lons >= -180) & (lons <= 180) &
+                                          (lats >= -90) & (lats <= 90))
+        # weights of the four corners
+        s__ = s__[:, np.newaxis]
+        t__ = t__[:, np.newaxis]
+        weights = np.hstack(((1 - s__) * (1 - t__),
+                             s__ * (1 - t__),
+                             (1 - s__) * t__,
+                             s__ * t__))
+        valid = np.isfinite(weights) & \
+            (index_array < valid_input_index.sum())
+
+    else:
+        raise ValueError(f'Unknown resample_method: {method}')
+
+    # map index of valid input/output to index of the whole grid
+    rows = np.flatnonzero(valid_output_index)[:, np.newaxis]
+    rows = np.broadcast_to(rows, index_array.shape)[valid]
+    cols = np.flatnonzero(valid_input_index)[index_array[valid]]
+
+    return sparse.csr_matrix((weights[valid], (rows, cols)),
+                             shape=(n_out, n_in))
+
+
+def _clip_polygons(poly, count, axis, value, sign):
+    '''
+    Clip polygons by the half-plane: sign*(poly[..., axis]-value) >= 0
+        poly: (n, m, 2) vertices, count: (n) number of vertices
+    '''
+    n, m, _ = poly.shape
+    index = np.arange(m)[np.newaxis, :]
+    valid = index < count[:, np.newaxis]
+    prev = (index - 1) % np.maximum(count, 1)[:, np.newaxis]
+
+    curr_p = poly
+    prev_p = np.take_along_axis(poly, prev[..., np.newaxis], axis=1)
+    curr_d = sign * (curr_p[..., axis] - value)
+    prev_d = sign * (prev_p[..., axis] - value)
+    curr_in = curr_d >= 0
+    prev_in = prev_d >= 0
+
+    # intersection of edge (prev -> curr) and the line,
+    #   padded vertices or edges not crossing the line (e.g. parallel)
+    #   give NaN or inf, which are never kept
+    crossing = (curr_in != prev_in) & valid
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        t = np.where(crossing, prev_d / (prev_d - curr_d), 0.)
+        cross_p = prev_p + t[..., np.newaxis] * (curr_p - prev_p)
+
+    # each vertex outputs: [intersection, curr]
+    out = np.stack((cross_p, curr_p), axis=2).reshape(n, 2*m, 2)
+    mask = np.stack((crossing,
+                     curr_in & valid), axis=2).reshape(n, 2*m)
+    # the padded vertices are 0, so the next clipping and the area are finite
+    out = np.where(mask[..., np.newaxis], out, 0.)
+
+    # move the kept vertices to the front
+    order = np.argsort(~mask, axis=1, kind='stable')
+    count = mask.sum(axis=1)
+    out = np.take_along_axis(out, order[..., np.newaxis], axis=1)
+
+    return out[:, :max(count.max(initial=0), 1)], count
+
+
+def _polygon_area(poly, count):
+    '''Area of polygons by the shoelace formula'''
+    index = np.arange(poly.shape[1])[np.newaxis, :]
+    valid = index < count[:, np.newaxis]
+    following = (index + 1) % np.maximum(count, 1)[:, np.newaxis]
+    next_p = np.take_along_axis(poly, following[..., np.newaxis], axis=1)
+    with np.errstate(invalid='ignore', over='ignore'):
+        cross = poly[..., 0]*next_p[..., 1] - next_p[..., 0]*poly[..., 1]
+
+    return np.abs(np.where(valid, cross, 0.).sum(axis=1)) / 2
+
+
+def calc_conservative_weights(lon_b, lat_b, area_def, chunk_size=1000000):
+    '''
+    Calculate the first-order conservative matrix
+        lon_b: (xdim+1), lat_b: (ydim+1) bounds of emission grid,
+            in the same order as the emission data
+        chunk_size: max number of (emission cell, WRF cell) pairs per chunk
+    '''
+    nrows, ncols = area_def.shape
+    x_ll, y_ll, x_ur, y_ur = area_def.area_extent
+    dx = (x_ur - x_ll) / ncols
+    dy = (y_ur - y_ll) / nrows
+
+    # corners of emission cells in the WRF plane: (n_emi_grid, 4, 2)
+    proj = Proj(area_def.proj_str)
+    x_b, y_b = proj(*np.meshgrid(lon_b, lat_b))
+    corners = np.stack([np.stack((x[:-1, :-1], x[:-1, 1:], x[1:, 1:], x[1:, :-1]),
+                                 axis=-1).reshape(-1, 4)
+                        for x in (x_b, y_b)], axis=-1)
+
+    # range of WRF cells (the row starts from the north)
+    col0 = np.floor((corners[..., 0].min(axis=1) - x_ll) / dx).astype(int)
+    col1 = np.floor((corners[..., 0].max(axis=1) - x_ll) / dx).astype(int)
+    row0 = np.floor((y_ur - corners[..., 1].max(axis=1)) / dy).astype(int)
+    row1 = np.floor((y_ur - corners[..., 1].min(axis=1)) / dy).astype(int)
+    col0, row0 = np.maximum(col0, 0), np.maximum(row0, 0)
+    col1, row1 = np.minimum(col1, ncols-1), np.minimum(row1, nrows-1)
+    ncol = np.maximum(col1 - col0 + 1, 0)
+    npair = ncol * np.maximum(row1 - row0 + 1, 0)
+
+    rows, cols, weights = [], [], []
+    ends = np.cumsum(npair)
+    start = 0
+    while start < len(npair):
+        # split emission cells into chunks of pairs
+        offset = ends[start] - npair[start]
+        end = max(np.searchsorted(ends, offset + chunk_size, side='right'),
+                  start + 1)
+        src = np.repeat(np.arange(start, end), npair[start:end])
+        k = np.arange(len(src)) - np.repeat(ends[start:end] - npair[start:end] - offset,
+                                            npair[start:end])
+        col = col0[src] + k % ncol[src]
+        row = row0[src] + k // ncol[src]
+
+        # clip by the WRF cell [0, dx] * [0, dy]
+        poly = corners[src] - np.stack((x_ll + col*dx, y_ur - (row+1)*dy),
+                                       axis=-1)[:, np.newaxis, :]
+        count = np.full(len(src), 4)
+        for axis, value, sign in [(0, 0, 1), (0, dx, -1),
+                                  (1, 0, 1), (1, dy, -1)]:
+            poly, count = _clip_polygons(poly, count, axis, value, sign)
+
+        fraction = _polygon_area(poly, count) / (dx*dy)
+        keep = fraction > 0
+        rows.append(row[keep]*ncols + col[keep])
+        cols.append(src[keep])
+        weights.append(fraction[keep])
+        start = end
+
+    return sparse.csr_matrix((np.concatenate(weights),
+                              (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(area_def.size, len(corners)))
+
+
+def get_weights(orig_def, area_def, geo_attrs, method,
+                radius_of_influence, cache_dir=None, bounds=None,
+                tile=None, memoize=True):
+    '''
+    Get the memoized resampling matrix,
+        if cache_dir is set, the matrix is read from or saved to
+        <cache_dir>/weights_<hash>.npz
+        tile: the tile of WRF domain which area_def covers
+        memoize: False for tiles, so the memory is bounded by one tile
+    '''
+    key = weights_hash(orig_def, geo_attrs, method, radius_of_influence,
+                       bounds=bounds, tile=tile)
+    if memoize and key in _weights_cache:
+        return _weights_cache[key]
+
+    # tiles are logged in debug mode
+    level = logging.INFO if tile is None else logging.DEBUG
+
+    filename = None
+    if cache_dir is not None:
+        filename = os.path.join(cache_dir, f'weights_{key}.npz')
+
+    if filename is not None and os.path.isfile(filename):
+        logging.log(level, f'Reading resampling weights from {filename}')
+        weights = sparse.load_npz(filename).tocsr()
+    else:
+        logging.log(level, f'Calculating {method} resampling weights ...')
+        weights = calc_weights(orig_def, area_def,
+                               method, radius_of_influence,
+                               bounds=bounds)
+        if filename is not None:
+            logging.log(level, f'Saving resampling weights to {filename}')
+            os.makedirs(cache_dir, exist_ok=True)
+            sparse.save_npz(filename, weights)
+
+    if memoize:
+        _weights_cache[key] = weights
+
+    return weights
+
+
+def to_wrf_order(weights, shape):
+    '''
+    Reorder rows of the resampling matrix,
+        the rows of pyresample output start from the north,
+        while WRF arrays start from the south.
+    '''
+    rows = np.arange(np.prod(shape)).reshape(shape)[::-1, :].ravel()
+
+    return weights[rows]
+
+
+def apply_weights(weights, data, shape, out=None):
+    '''
+    Resample data (..., y, x) by the sparse matrix in one product
+        shape: (y, x) shape of the output
+        out: optional preallocated array with shape (..., *shape)
+    '''
+    data = np.asarray(data)
+    lead_shape = data.shape[:-2]
+    # (n_emi_grid, n_fields) -> (n_wrf_grid, n_fields)
+    resampled = weights @ data.reshape(-1, weights.shape[1]).T
+    resampled = resampled.T.reshape(lead_shape + tuple(shape))
+
+    if out is None:
+        return resampled
+
+    out[...] = resampled
+
+    return out
+
+
+def resample_grid(emi, lon, lat, lon_b, lat_b, area_def, geo_attrs, method,
+                  radius_of_influence, cache_dir=None, tile=None, memoize=True,
+                  fill_nan=False):
+    '''
+    Resample a regular lon/lat grid to the area,
+        just the cells around the area are read and used by the weights
+        emi: (..., y, x) array or lazy DataArray
+        lon/lat: 1d centers, lon_b/lat_b: 1d bounds
+        fill_nan: replace NaN of the cells around the area by 0
+        return: array (..., south_north, west_east), rows start from the south
+    '''
+    try:
+        y, x = crop_window(lon_b, lat_b,
+                           domain_bbox([area_def], radius_of_influence),
+                           level=logging.INFO if tile is None else logging.DEBUG)
+    except ValueError:
+        # the area is far away from the grid
+        return np.zeros(emi.shape[:-2] + area_def.shape, dtype=emi.dtype)
+
+    lon2d, lat2d = np.meshgrid(lon[x], lat[y])
+    weights = get_weights(SwathDefinition(lons=lon2d, lats=lat2d),
+                          area_def,
+                          geo_attrs,
+                          method,
+                          radius_of_influence,
+                          cache_dir=cache_dir,
+                          bounds=(lon_b[x.start:x.stop+1], lat_b[y.start:y.stop+1]),
+                          tile=tile,
+                          memoize=memoize)
+
+    # rows of WRF start from the south
+    #   and the product keeps the precision of emissions
+    weights = to_wrf_order(weights, area_def.shape).astype(emi.dtype)
+
+    data = np.asarray(emi[..., y, x])
+    if fill_nan:
+        data = np.nan_to_num(data)
+
+    return apply_weights(weights, data, area_def.shape)
+
+
+def init_pool_weights(weights, shape):
+    '''Set the weights once for each worker of process pool'''
+    global _pool_weights, _pool_shape
+    _pool_weights = weights
+    _pool_shape = shape
+
+
+def apply_pool_weights(data):
+    '''Resample data by the weights set by init_pool_weights'''
+    return apply_weights(_pool_weights, data, _pool_shape)
@@ -0,0 +1,65 @@
+'''
+Emission scenarios as factors of sectors and species
+
+Scenarios are defined in a YAML file like scenario_example.yaml:
+    <scenario name>:
+        sectors: {<sector>: factor, ...}
+        species: {<WRF-Chem species or group>: factor, ...}
+Groups are VOC and SOLID species of conversion_table.csv.
+
+The factor of one species and sector is
+    (factor of sector) * (factor of species),
+    it is multiplied to the temporal factors of the species,
+    so each scenario is a linear combination of the resampled base.
+'''
+
+import numpy as np
+
+
+def load_scenarios(filename):
+    '''
+    Read scenarios from the YAML file
+        return: {name: {'sectors': {...}, 'species': {...}}}
+    '''
+    import yaml
+
+    with open(filename) as f:
+        scenarios = yaml.safe_load(f) or {}
+
+    for name, scenario in scenarios.items():
+        scenario = scenario or {}
+        unknown = set(scenario) - {'sectors', 'species'}
+        if unknown:
+            raise ValueError(f'Unknown keys of scenario {name}: {unknown}')
+        scenarios[name] = {'sectors': scenario.get('sectors') or {},
+                           'species': scenario.get('species') or {}}
+
+    return scenarios
+
+
+def scenario_factors(scenario, names, sectors, groups={}):
+    '''
+    Get factors of the scenario
+        names: WRF-Chem species
+        sectors: names of sectors (kind)
+        groups: {group: [species]}
+        return: array with shape (len(names), len(sectors))
+    '''
+    factors = np.ones((len(names), len(sectors)))
+
+    sectors = [sector.upper() for sector in sectors]
+    for sector, factor in scenario['sectors'].items():
+        if sector.upper() not in sectors:
+            raise ValueError(f'Unknown sector {sector}, choose from {sectors}')
+        factors[:, sectors.index(sector.upper())] *= factor
+
+    for species, factor in scenario['species'].items():
+        if species in groups:
+            index = [names.index(name) for name in groups[species]]
+        elif species in names:
+            index = [names.index(species)]
+        else:
+            raise ValueError(f'Unknown species {species}')
+        factors[index, :] *= factor
+
+    return factors
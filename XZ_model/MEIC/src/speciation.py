@@ -0,0 +1,122 @@
+'''
+Compile conversion_table.csv into a speciation matrix
+
+Each row of the table maps the sum of MEIC species (spec_a+spec_b+...)
+    of one mechanism to one WRF-Chem species.
+The rows are compiled into a sparse matrix (wrf species, MEIC species)
+    which includes the weights and unit factors,
+    then the speciation of all sectors is one matrix product:
+    (wrf*meic) x (meic*kind*grid) = wrf*kind*grid
+    and the result is divided by the area of grid.
+
+If one WRF-Chem species is defined in several rows,
+    the last one is used.
+'''
+
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# columns after the mechanisms
+param_cols = ['WEIGHT', 'SOLID', 'VOC', 'MW']
+
+
+def read_table(filename):
+    '''Read the conversion table, any number of mechanisms is fine'''
+    df = pd.read_csv(filename,
+                     sep=' *, *',  # delete spaces
+                     comment='#',
+                     engine='python',
+                     dtype=str)
+    df[param_cols] = df[param_cols].astype(np.float64)
+
+    return df
+
+
+def unit_factor(solid, voc, mw, days):
+    '''Factor and units of converting MEIC units to WRF-Chem units'''
+    seconds = days*24*3600
+    hours = days*24
+    if solid:
+        # WRF-Chem unit: ug/m3 m/s
+        # MEIC: unit: tg/(grid*month)
+        return 1e12/seconds, 'ug/m3 m/s'
+    elif voc:
+        # WRF-Chem unit: mol km-2 hr-1
+        # MEIC unit: 10**6 mol/(grid*month)
+        return 1e12/hours, 'mol km^-2 hr^-1'
+    else:
+        # WRF-Chem unit: mol km-2 hr-1
+        # MEIC unit: tg/(grid*month)
+        return 1e12/(hours*mw), 'mol km^-2 hr^-1'
+
+
+def compile_table(df, days):
+    '''
+    Compile the conversion table
+        days: number of days of the month
+        return: names and units of WRF-Chem species,
+                keys of MEIC species [(mechanism, species)],
+                sparse matrix (len(names), len(keys))
+    '''
+    mechanisms = df.columns[1:-len(param_cols)-1]
+    # name: (keys, factor, units)
+    rows = {}
+    for col in df.columns[1:-len(param_cols)]:
+        # species in ALL column are read from any mechanism
+        if col == 'ALL':
+            col_path = mechanisms[0]
+        else:
+            col_path = col
+
+        for index, spec in df[col].dropna().items():
+            row = df.loc[index]
+            name = row[df.columns[0]]
+            logging.info(' '*8+'Map '+spec+' to '+name+' species')
+            factor, units = unit_factor(row['SOLID'], row['VOC'], row['MW'], days)
+            rows[name] = ([(col_path, s) for s in spec.split('+')],
+                          row['WEIGHT']*factor,
+                          units)
+
+    names = list(rows)
+    units = [value[2] for value in rows.values()]
+    keys = list(dict.fromkeys(key for value in rows.values() for key in value[0]))
+
+    i, j, factors = [], [], []
+    for index, (spec_keys, factor, _) in enumerate(rows.values()):
+        for key in spec_keys:
+            i.append(index)
+            j.append(keys.index(key))
+            factors.append(factor)
+
+    # duplicated terms are summed like spec_a+spec_a
+    matrix = sparse.csr_matrix((factors, (i, j)), shape=(len(names), len(keys)))
+
+    return names, units, keys, matrix
+
+
+def species_groups(df, names):
+    '''Get VOC and SOLID species of the conversion table'''
+    groups = {}
+    for group in ['VOC', 'SOLID']:
+        species = set(df.loc[df[group] == 1, df.columns[0]])
+        groups[group] = [name for name in names if name in species]
+
+    return groups
+
+
+def apply_speciation(matrix, cube, area):
+    '''
+    Map MEIC species to WRF-Chem species
+        cube: (MEIC species, kind, y, x), unit: per grid
+        area: (y, x), unit: m2
+        return: (WRF-Chem species, kind, y, x), unit: per m2
+            with the same dtype as cube
+    '''
+    emi = matrix.astype(cube.dtype) @ cube.reshape(cube.shape[0], -1)
+    emi = emi.reshape((matrix.shape[0],) + cube.shape[1:])
+    emi /= area
+
+    return emi
@@ -0,0 +1,88 @@
+'''
+Temporal profiles of emission sectors
+
+Three optional csv files in profile_dir (default: the dir of this script):
+    monthly_factor.csv: 12*5 (month*kind), January ~ December
+    weekly_factor.csv: 7*5 (day*kind), Monday ~ Sunday
+    hourly_factor.csv: 24*5 (hour*kind), 00 ~ 23 UTC
+The first two lines are the header and each profile is normalized to mean 1,
+    1 is used instead if the file does not exist.
+
+MEIC and VITO are already totals of the inventory month,
+    so their monthly factors are relative to that month:
+    monthly[month of time] / monthly[inventory month],
+    which is 1 for the days of the inventory month.
+
+The factor of one time and kind is monthly*weekly*hourly,
+    and it is applied to all species in one einsum:
+    (time*kind) .* (species*kind*grid) = species*time*grid
+'''
+
+import logging
+import os
+from functools import lru_cache
+
+import numpy as np
+
+profile_dir = os.path.dirname(os.path.abspath(__file__))
+
+# name: (file, length)
+profiles = {'monthly': ('monthly_factor.csv', 12),
+            'weekly': ('weekly_factor.csv', 7),
+            'hourly': ('hourly_factor.csv', 24),
+            }
+
+
+@lru_cache(maxsize=None)
+def load_profiles(nkind=5, profile_dir=profile_dir):
+    '''
+    Read and normalize the profiles just once
+        return: {name: array with shape (length, nkind)}
+    '''
+    factors = {}
+    for name, (filename, length) in profiles.items():
+        filename = os.path.join(profile_dir, filename)
+        try:
+            table = np.genfromtxt(filename,
+                                  delimiter=',',
+                                  comments='#',
+                                  usecols=tuple(range(nkind)),
+                                  skip_header=2).reshape(length, nkind)
+            table = table / table.mean(axis=0)
+        except OSError:
+            logging.info(' '*8 +
+                         f'{os.path.basename(filename)} does not exist, use 1 instead')
+            table = np.ones((length, nkind))
+        factors[name] = table
+
+    return factors
+
+
+def temporal_factors(times, nkind=5, profile_dir=profile_dir, month=None):
+    '''
+    Get factors of datetimes
+        month: month (1 ~ 12) of emissions which are monthly totals,
+            None for annual emissions
+        return: array with shape (time, kind)
+    '''
+    factors = load_profiles(nkind, profile_dir)
+    monthly = factors['monthly']
+    if month is not None:
+        monthly = monthly / monthly[month-1]
+    months = [t.month-1 for t in times]
+    weekday = [t.weekday() for t in times]
+    hour = [t.hour for t in times]
+
+    return monthly[months] * \
+        factors['weekly'][weekday] * \
+        factors['hourly'][hour]
+
+
+def apply_factors(factors, emi, out=None):
+    '''
+    Apply temporal factors to emissions of all species
+        factors: (time, kind)
+        emi: (species, kind, ...)
+        out: optional preallocated array with shape (species, time, ...)
+    '''
+    return np.einsum('tk,sk...->st...', factors, emi, out=out)
@@ -0,0 +1,72 @@
+'''
+Split WRF domains into tiles
+
+Large domains (e.g. 1 km) are split into tiles of tile_size*tile_size cells,
+    each tile has its own resampling weights from the emission cells
+    around it (crop.py), so the lon/lat, weights and resampled
+    emissions in memory are bounded by the size of tile.
+The results are same as the whole domain, because cells out of the box
+    of tile plus radius_of_influence are never used by the weights.
+
+The emission grid is shared by the workers once (parallel.init_shared):
+    emi: (species, kind, y, x), lon/lat: 1d centers, lon_b/lat_b: 1d bounds
+The rows of tiles start from the south like WRF arrays,
+    and tiles are aligned with the chunks of output variables.
+'''
+
+from itertools import product
+
+from parallel import shared
+from regrid import resample_grid
+
+
+def split_tiles(shape, tile_size):
+    '''
+    Split the WRF grid into tiles
+        shape: (south_north, west_east)
+        return: list of (slice of south_north, slice of west_east)
+    '''
+    return list(product(*[split_axis(n, tile_size) for n in shape]))
+
+
+def split_axis(n, tile_size):
+    '''
+    Split one axis into slices of tile_size,
+        the remainder shorter than half tile is merged into the last slice,
+        so the tiles at the edges are not too thin for the resampling
+    '''
+    starts = list(range(0, n, tile_size))
+    if len(starts) > 1 and n - starts[-1] < tile_size / 2:
+        starts.pop()
+
+    return [slice(start, stop) for start, stop in zip(starts, starts[1:] + [n])]
+
+
+def tile_area_def(area_def, tile):
+    '''AreaDefinition of the tile (rows of pyresample start from the north)'''
+    y, x = tile
+    ny = area_def.shape[0]
+
+    return area_def[ny-y.stop:ny-y.start, x]
+
+
+def resample_tile(job):
+    '''
+    Resample the shared emissions to one tile
+        job: (area_def, tile, geo_attrs, method, radius_of_influence, cache_dir)
+        return: array (species, kind, tile_y, tile_x)
+    '''
+    area_def, tile, geo_attrs, method, radius_of_influence, cache_dir = job
+
+    return resample_grid(shared['emi'],
+                         shared['lon'],
+                         shared['lat'],
+                         shared['lon_b'],
+                         shared['lat_b'],
+                         tile_area_def(area_def, tile),
+                         geo_attrs,
+                         method,
+                         radius_of_influence,
+                         cache_dir=cache_dir,
+                         tile=tile,
+                         memoize=False)
@@ -0,0 +1,57 @@
+'''
+Vertical profiles of emission sectors
+
+One optional csv file in profile_dir (default: the dir of this script):
+    vertical_factor.csv: nz*5 (level*kind), from the surface to the top
+The first two lines are the header and each profile is normalized to sum 1,
+    all emissions are put into the surface layer (nz = 1)
+    if the file does not exist.
+The levels are the emission levels of WRF-Chem (kemit = nz),
+    so the profiles depend on the eta levels of the simulation.
+
+The vertical factors are combined with the temporal factors:
+    (time*kind) .* (level*kind) = time*level*kind
+    then it is applied to the sectors in one product like temporal factors.
+'''
+
+import logging
+import os
+from functools import lru_cache
+
+import numpy as np
+
+profile_dir = os.path.dirname(os.path.abspath(__file__))
+profile_file = 'vertical_factor.csv'
+
+
+@lru_cache(maxsize=None)
+def load_vertical(nkind=5, profile_dir=profile_dir):
+    '''
+    Read and normalize the profiles just once
+        return: array with shape (nz, nkind)
+    '''
+    filename = os.path.join(profile_dir, profile_file)
+    try:
+        table = np.genfromtxt(filename,
+                              delimiter=',',
+                              comments='#',
+                              usecols=tuple(range(nkind)),
+                              skip_header=2).reshape(-1, nkind)
+        table = table / table.sum(axis=0)
+        logging.info(' '*8 + f'Distribute emissions into {table.shape[0]} levels')
+    except OSError:
+        logging.info(' '*8 +
+                     f'{profile_file} does not exist, use the surface layer instead')
+        table = np.ones((1, nkind))
+
+    return table
+
+
+def vertical_factors(factors, profile):
+    '''
+    Combine temporal and vertical factors
+        factors: (time, kind)
+        profile: (nz, kind)
+        return: array with shape (time, nz, kind)
+    '''
+    return factors[:, np.newaxis, :] * profile
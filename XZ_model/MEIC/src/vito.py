@@ -4,8 +4,8 @@ INPUT:
     VITO input files
 
 OUTPUT:
-    wrfchemi_00z_d01: 0 ~ 11 h
-    wrfchemi_12z_d01: 12 ~ 23 h
+    wrfchemi_00z_d<domain>: 0 ~ 11 h
+    wrfchemi_12z_d<domain>: 12 ~ 23 h
 
 UPDATE:
     Xin Zhang:
@@ -15,28 +15,51 @@ Steps:
     1. Create WRF area by reading the info of geo* file
     2. Read MEIC nc files and map species to WRF-Chem species
         and assign to self.vito[species]
-    3. Resample self.vito to WRF area, write attributes,
-        and assign to self.chemi[species]
-    4. Export self.chemi to replace variables two 12-hour netCDF files.
+    3. Resample self.vito of each sector to WRF area
+    4. Apply monthly, weekly and hourly factors (and vertical profiles),
+        and replace variables in two 12-hour netCDF files.
+        By default, the files are copied and just the variables
+        are overwritten (overlay).
+        The files of days (dd ~ dd_end) and scenarios (scenario_file)
+        are found in the same layout as the output of mozcart.py.
+        The sector tags (E_<SPEC>_<SECTOR>) of the species are
+        replaced by the VITO kinds of the same columns in *_factor.csv.
+    Step 1, 3 and 4 are run for each domain in parallel,
+        while the VITO file is just read once.
+    If crop is True, VITO is cropped to the domains before step 2.
+    If tile_size is set, step 3 is run tile by tile.
 
 The VITO file just contains three species:
     NOx, PM25 and SO2.
 We will replace these species in wrfchemi* files
     generated by mozcart.py which uses MEIC data.
+Or VITO can be blended with MEIC by mozcart.py directly,
+    see read_inventory and blend.py.
 
 '''
 
 import logging
 import os
+import shutil
 from calendar import monthrange
 from datetime import datetime, timedelta
-from time import strftime
+from itertools import product
 
 import numpy as np
 import xarray as xr
-from pyresample.bilinear import resample_bilinear
-from pyresample.geometry import AreaDefinition, SwathDefinition
-from pyresample.kd_tree import resample_custom, resample_nearest
+from netCDF4 import Dataset
+
+from budget import budget_totals, report_budget
+from chemi_cache import load_manifest, manifest_name, save_manifest
+from chemi_writer import chemi_attrs, dims
+from crop import crop_window, domain_bbox
+from domain import get_info, perdelta, resample_domain
+from emi_stats import stats_table
+from grid_area import get_grid_area
+from parallel import map_jobs
+from scenario import load_scenarios, scenario_factors
+from temporal import apply_factors, temporal_factors
+from vertical import load_vertical, vertical_factors
 
 # Choose the following line for info or debugging:
 # logging.basicConfig(level=logging.INFO)
@@ -47,76 +70,142 @@ data_path = '../input_files/'
 wrfchemi_dir = '../output_files/'
 output_dir = '../output_files/vito/'
 vito_filename = 'VITO_STD-RES-INVENTORY_EAST-CHINA.nc'
-domain = 'd01'
-resample_method = 'bilinear'  # nearest, bilinear or idw
-
+# all domains share the VITO data read once, e.g. ['d01', 'd02', 'd03']
+domains = ['d01']
+# number of processes for domains
+nprocs_domain = len(domains)
+resample_method = 'bilinear'  # nearest, bilinear, idw or conservative
+# radius (m) of the resampling and of the box of crop
+radius_of_influence = 200e3
+# resampling weights are saved to cache_dir
+cache_dir = '../cache_files/'
+# save cell areas of VITO grid to data_path/area_<hash>.npy
+save_area = True
+# just read VITO cells in the box of domains plus radius_of_influence
+crop = True
+# compare domain totals before and after resampling,
+#   and warn if the relative loss of any hourly total > budget_tol
+check_budget = True
+budget_tol = 0.05
+# how to replace the species in wrfchemi* files generated by mozcart.py
+#   'copy': copy the files to output_dir, then just overwrite the species
+#   'inplace': just overwrite the species in the files of wrfchemi_dir,
+#       their hashes are removed, so mozcart.py regenerates them next time
+#   'rewrite': read all variables and save new files to output_dir
+overlay = 'copy'
+# YAML file of scenarios of mozcart.py, the files in wrfchemi_dir/<scenario>/
+#   are also replaced and VITO species are scaled by the scenario,
+#   species of the scenario which are not in VITO are skipped. None: just the base
+scenario_file = None
+# resample domains by tiles of tile_size*tile_size cells (e.g. 500 for 1 km domains),
+#   so the lon/lat and weights in memory are bounded by tiles.
+#   None: the whole domain at once
+tile_size = None
+# number of processes for tiles of each domain
+nprocs_tile = 1
+# precision of emissions from reading to writing
+#   WRF-Chem reads emissions as REAL (float32)
+emi_dtype = np.float32
+# year of the VITO inventory (the file contains several years)
+yyyy_vito = 2016
 # simulated date
 # emissions of any day in the month are same
 yyyy = 2019
 mm = 7
 dd = 25
+# last simulated day in the month, same as mozcart.py
+#   if dd_end > dd, the files of each day are in wrfchemi_dir/<yyyymmdd>/
+dd_end = 25
 
 # Please don't change the following paras
 minhour = 0
 maxhour = 23
 delta = 1  # unit: hour
-days = monthrange(yyyy, mm)[1]  # get number of days of the month
-chem1 = wrfchemi_dir+"wrfchemi_00z_d"+domain
-chem2 = wrfchemi_dir+"wrfchemi_12z_d"+domain
-
-wrf_projs = {1: 'lcc',
-             2: 'npstere',
-             3: 'merc',
-             6: 'eqc'
-             }
+# MEIC sectors of the VITO kinds (Fires, Industry, Energy, Residential, Traffic),
+#   in the order of columns in *_factor.csv, used by sectors of scenarios
+#   and the sector tags (E_<SPEC>_<SECTOR>) of mozcart.py
+sectors = ['AGRICULTURE', 'INDUSTRY', 'POWER', 'RESIDENTIAL', 'TRANSPORTATION']
 
 
 class vito(object):
-    def __init__(self, st, et, delta):
-        self.get_info()
-        self.read_vito()
-        self.resample_WRF(st, et, delta)
-        self.replace_var()
+    def __init__(self, ):
+        # statistics of species are reported at the end
+        self.stats = stats_table()
+        self.radius_of_influence = radius_of_influence
+
+    def run(self, st, et, delta):
+        '''Replace VITO species in wrfchemi* files of all domains'''
+        # WRF areas of all domains
+        infos = {domain: get_info(data_path, domain) for domain in domains}
+        self.read_vito([area_def for _, area_def in infos.values()])
+        self.scenarios = self.get_scenarios()
+
+        # the statistics collected in processes are returned
+        #   and merged in the order of domains
+        nrows = len(self.stats.rows)
+        results = map_jobs(self.process_domain,
+                           [(domain, *infos[domain], st, et, delta) for domain in domains],
+                           nprocs_domain)
+        self.stats.rows = self.stats.rows[:nrows] + \
+            [row for rows in results for row in rows]
+
+        self.stats.log()
+        logging.info('----- Successfully -----')
 
-    def get_info(self, ):
+    def process_domain(self, job):
         '''
-        Read basic info from geo file generated by WPS
-            If want to run this on your laptop and care about the space,
-            you can use ncks to subset the nc file (we just need attrs)
-            ncks -F -d Time,1,,1000 -v Times geo_em.d01.nc geo_em.d01_subset.nc
-        ref: https://fabienmaussion.info/2018/01/06/wrf-projection/
+        Resample emissions of one domain and replace them in wrfchemi* files
+            return: statistics of the domain
         '''
-        self.geo = xr.open_dataset(data_path + 'geo_em.'+domain+'.nc')
-        attrs = self.geo.attrs
-        i = attrs['WEST-EAST_GRID_DIMENSION'] - 1
-        j = attrs['SOUTH-NORTH_GRID_DIMENSION'] -1
-
-        # calculate attrs for area definition
-        shape = (j, i)
-        radius = (i*attrs['DX']/2, j*attrs['DY']/2)
-        self.radius_of_influence = 200e3
-
-        # create area as same as WRF
-        area_id = 'wrf_circle'
-        proj_dict = {'proj': wrf_projs[attrs['MAP_PROJ']],
-                     'lat_0': attrs['CEN_LAT'],
-                     'lon_0': attrs['CEN_LON'],
-                     'lat_1': attrs['TRUELAT1'],
-                     'lat_2': attrs['TRUELAT2'],
-                     'a': 6370000,
-                     'b': 6370000}
-        center = (0, 0)
-        self.area_def = AreaDefinition.from_circle(area_id,
-                                                   proj_dict,
-                                                   center,
-                                                   radius,
-                                                   shape=shape)
-        logging.info(f'Area: {self.area_def}')
-
-    def read_vito(self, ):
-        '''Read VITO data and convert to species in MOZART'''
-        # read VITO nc file
+        domain, geo, area_def, st, et, delta = job
+        nrows = len(self.stats.rows)
+        wrf_emi = self.resample_WRF(geo, area_def)
+
+        # files of days and scenarios are in the same layout as mozcart.py
+        for day, (scenario, scale) in product(perdelta(st, et, timedelta(days=1)),
+                                              self.scenarios):
+            subdir = ''
+            if scenario is not None:
+                subdir += scenario + '/'
+            if st.date() != et.date():
+                subdir += day.strftime('%Y%m%d') + '/'
+            self.replace_var(day, day.replace(hour=maxhour), delta, domain, wrf_emi,
+                             subdir, scale)
+
+        if check_budget:
+            times = list(perdelta(st, et, timedelta(hours=delta)))
+            factors = temporal_factors(times, wrf_emi.shape[1], month=mm).astype(emi_dtype)
+            totals = budget_totals([self.emi[vname].values for vname in self.vnames],
+                                   self.emi_lon_b,
+                                   self.emi_lat_b,
+                                   self.emi_area.values,
+                                   wrf_emi,
+                                   area_def)
+            report_budget(f'{domain} {st:%Y%m%d}',
+                          self.vnames, *totals, factors, budget_tol)
+
+        return self.stats.rows[nrows:]
+
+    def read_vito(self, area_defs, mm=mm):
+        '''
+        Read VITO data and convert to species in MOZART
+            mm: simulated month, default: the setting of this script,
+                the month of yyyy_vito is read
+        '''
+        # open VITO nc file, the variables are read lazily
         ds = xr.open_dataset(data_path+vito_filename)
+        # select the month of the inventory year by index before reading any variable,
+        #   so just the data of the month (and the cropped cells) is read
+        index = np.flatnonzero((ds['time.year'].values == yyyy_vito) &
+                               (ds['time.month'].values == mm))
+        if index.size != 1:
+            raise ValueError(f'{data_path+vito_filename} has {index.size} time steps '
+                             f'of {yyyy_vito}-{mm:02d} (yyyy_vito and mm), expect 1')
+        ds = ds.isel(time=index)
+        # the monthly totals are converted to rates by the days of the inventory month
+        days = monthrange(yyyy_vito, mm)[1]
+        if crop:
+            ds = self.crop_grid(ds, area_defs)
 
         # molecular weights
         var_dict = {'E_NO': 14,
@@ -133,60 +222,85 @@ class vito(object):
                 species = [name[2:]+'x_'+t for t in types]
             else:
                 species = [name[2:]+'_'+t for t in types]
-            ds_var = ds[species]
+            # read the sectors of the species
+            ds_var = ds[species].load()
 
             if not emi_exist:
                 # just read lon/lat once
                 self.calc_area(ds_var)
-                self.emi = self.get_ds(ds_var, name, var_dict, mm)
+                self.emi = self.get_ds(ds_var, name, var_dict, days)
 
             else:
-                self.emi[name] = self.get_ds(ds_var, name, var_dict, mm)[name]
+                self.emi[name] = self.get_ds(ds_var, name, var_dict, days)[name]
+
+            self.stats.add('VITO', name, self.emi[name].values)
+
+        self.vnames = [vname for vname in self.emi.data_vars if 'E_' in vname]
+
+    def get_scenarios(self):
+        '''
+        Get factors (species, kind) of scenarios in scenario_file, None is the base
+            species which are not in VITO are skipped
+        '''
+        scenarios = [(None, np.ones((len(self.vnames), len(sectors))))]
+        if scenario_file is not None:
+            for name, scenario in load_scenarios(scenario_file).items():
+                species = {key: value for key, value in scenario['species'].items()
+                           if key in self.vnames}
+                scenarios.append((name, scenario_factors(dict(scenario, species=species),
+                                                         self.vnames,
+                                                         sectors)))
+
+        return scenarios
+
+    def grid_bounds(self, ds):
+        '''Get the lon/lat bounds (lat: north to south) of VITO grid'''
+        attrs = ds.attrs
+        lon_b = np.linspace(float(attrs['grid_westb']),
+                            float(attrs['grid_eastb']),
+                            ds.sizes['lon']+1)
+        lat_b = np.linspace(float(attrs['grid_northb']),
+                            float(attrs['grid_southb']),
+                            ds.sizes['lat']+1)
 
-            logging.debug(' '*8 +
-                          ' min: ' + str(self.emi[name].min().values) +
-                          ' max: ' + str(self.emi[name].max().values) +
-                          ' mean ' + str(self.emi[name].mean().values)
-                          )
+        return lon_b, lat_b
+
+    def crop_grid(self, ds, area_defs):
+        '''
+        Crop the Dataset to the box of domains plus radius_of_influence
+            the grid attrs are updated to the cropped grid
+        '''
+        lon_b, lat_b = self.grid_bounds(ds)
+        bbox = domain_bbox(area_defs, self.radius_of_influence)
+        y, x = crop_window(lon_b, lat_b, bbox)
+
+        ds = ds.isel(lat=y, lon=x)
+        ds.attrs.update({'grid_westb': lon_b[x.start],
+                         'grid_eastb': lon_b[x.stop],
+                         'grid_northb': lat_b[y.start],
+                         'grid_southb': lat_b[y.stop]})
+
+        return ds
 
     def calc_area(self, ds):
         '''Get the lon/lat and area (m2)of emission gridded data'''
-        attrs = ds.attrs
         # get lon/lat bounds
-        self.emi_lon_b = np.linspace(float(attrs['grid_westb']),
-                                     float(attrs['grid_eastb']),
-                                     ds.sizes['lon']+1)
-        self.emi_lat_b = np.linspace(float(attrs['grid_northb']),
-                                     float(attrs['grid_southb']),
-                                     ds.sizes['lat']+1)
+        self.emi_lon_b, self.emi_lat_b = self.grid_bounds(ds)
 
         # get lon/lat
         self.emi_lon = ds.coords['lon']
         self.emi_lat = ds.coords['lat']
 
-        # ref: https://github.com/Timothy-W-Hilton/STEMPyTools
-        lon_bounds2d, lat_bounds2d = np.meshgrid(self.emi_lon_b, self.emi_lat_b)
-        EARTH_RADIUS = 6370000.0
-        Rad_per_Deg = np.pi / 180.0
-
-        ydim = lon_bounds2d.shape[0]-1
-        xdim = lon_bounds2d.shape[1]-1
-        area = np.full((ydim, xdim), np.nan)
-        for j in range(ydim):
-            for i in range(xdim):
-                xlon1 = lon_bounds2d[j, i]
-                xlon2 = lon_bounds2d[j, i+1]
-                ylat1 = lat_bounds2d[j, i]
-                ylat2 = lat_bounds2d[j+1, i]
-
-                cap_ht = EARTH_RADIUS * (1 - np.sin(ylat1 * Rad_per_Deg))
-                cap1_area = 2 * np.pi * EARTH_RADIUS * cap_ht
-                cap_ht = EARTH_RADIUS * (1 - np.sin(ylat2 * Rad_per_Deg))
-                cap2_area = 2 * np.pi * EARTH_RADIUS * cap_ht
-                area[j, i] = abs(cap1_area - cap2_area) * abs(xlon1 - xlon2) / 360.0
+        # the area is read from cache if the grid has been used
+        if save_area:
+            cache_dir = data_path
+        else:
+            cache_dir = None
+        area = get_grid_area(self.emi_lon_b, self.emi_lat_b,
+                             cache_dir=cache_dir)
 
         # save to DataArray
-        self.emi_area = xr.DataArray(area,
+        self.emi_area = xr.DataArray(area.astype(emi_dtype),
                                      dims=['lat', 'lon'],
                                      coords={'lon': ds.coords['lon'],
                                              'lat': ds.coords['lat']}).rename('area')
@@ -202,8 +316,11 @@ class vito(object):
                                       dims=['lat', 'lon'])
 
 
-    def get_ds(self, ds, name, var_dict, mm):
-        '''Generate the Dataset for species'''
+    def get_ds(self, ds, name, var_dict, days):
+        '''
+        Generate the Dataset for species of each sector
+            days: number of days of the month
+        '''
         seconds = days*24*3600
         hours = days*24
 
@@ -214,9 +331,8 @@ class vito(object):
         else:
             varname = name.split('_')[-1]+'_Industry'
 
-        # subset data to selected month
+        # the month is already selected by read_vito
         ds = ds.where(ds != ds[varname].attrs['MissingValue'])
-        ds = ds.where(ds['time.month'] == mm, drop=True)
 
         if name == 'E_PM25':
             # WRF-Chem unit: ug/m3 m/s
@@ -226,40 +342,18 @@ class vito(object):
             # WRF-Chem unit: mol km-2 hr-1
             ds = ds*1e9/(self.emi_area/1e6)/(hours*var_dict[name])
 
-        # read hourly factor table
+        # stack sectors in the order of columns in *_factor.csv
         kind = ['Fires', 'Industry', 'Energy', 'Residential', 'Traffic']
-        try:
-            # shape: 24*5 (time*kind)
-            table = xr.DataArray(np.genfromtxt('./hourly_factor.csv',
-                                               delimiter=',',
-                                               comments='#',
-                                               usecols=(0, 1, 2, 3, 4),
-                                               skip_header=2),
-                                 dims=['hour', 'kind'],
-                                 coords={'hour': np.arange(0, 24, 1),
-                                         'kind': kind}
-                                 )
-            table = table/(table.sum(dim='hour')/24)
-
-        except OSError:
-            logging.info(' '*8 +
-                         'hourly_factor.csv does not exist, use 1 instead')
-            table = xr.DataArray(np.full((24, 5), 1),
-                                 dims=['hour', 'kind'],
-                                 coords={'hour': np.arange(0, 24, 1),
-                                         'kind': kind}
-                                 )
-
-        ds[name] = xr.DataArray(np.full((24, len(ds.lat), len(ds.lon)), 0.),
-                                dims=['hour', 'lat', 'lon']).rename(name)
-
-        # multiply data by hourly factor and sum to total
-        for k in kind:
-            ds[name] += (ds[varname.split('_')[-2]+'_'+k] * table.sel(kind=k)).squeeze('time')
+        ds[name] = xr.concat([ds[varname.split('_')[-2]+'_'+k] for k in kind],
+                             dim='kind').squeeze('time', drop=True)
+        ds[name] = ds[name].assign_coords(kind=kind)
+
+        # missing values are no emission,
+        #   otherwise they are spread by the resampling weights
+        ds[name] = ds[name].fillna(0.).astype(emi_dtype)
 
         # drop 'kind' variables
         ds = ds.drop_vars([key for key in list(ds.keys()) if 'E_' not in key])
-        ds = ds.drop('kind')
 
         # add longitude and latitude variables
         lon2d, lat2d = np.meshgrid(ds.lon, ds.lat)
@@ -279,145 +373,198 @@ class vito(object):
 
         return ds
 
-    def perdelta(self, start, end, delta):
-        '''Generate the 24-h datetime list'''
-        curr = start
-        while curr <= end:
-            yield curr
-            curr += delta
-
-    def resample_WRF(self, st, et, delta):
-        '''Create Times variable and resample emission species DataArray.'''
-        # generate date every hour
-        datetime_list = list(self.perdelta(st, et, timedelta(hours=1)))
-        t_format = '%Y-%m-%d_%H:%M:%S'
-
-        # convert datetime to date string
-        Times = []
-        for timstep in datetime_list:
-            times_str = strftime(t_format, timstep.timetuple())
-            Times.append(times_str)
-
-        # the method of creating "Times" with unlimited dimension
-        # ref: htttps://github.com/pydata/xarray/issues/3407
-        Times = xr.DataArray(np.array(Times,
-                                      dtype=np.dtype(('S', 19))
-                                      ),
-                             dims=['Time'])
-
-        self.chemi = xr.Dataset({'Times': Times})
-
-        # resample
-        orig_def = SwathDefinition(lons=self.emi['longitude'],
-                                   lats=self.emi['latitude'])
-        for vname in self.emi.data_vars:
-            if 'E_' in vname:
-                logging.info(f'Resample {vname} ...')
-                resampled_list = []
-                for t in range(self.emi[vname].shape[0]):
-                    # different resample methods
-                    # see: http://earthpy.org/interpolation_between_grids_with_pyresample.html
-                    if resample_method == 'nearest':
-                        resampled_list.append(resample_nearest(
-                                              orig_def,
-                                              self.emi[vname][t, :, :].values,
-                                              self.area_def,
-                                              radius_of_influence=self.radius_of_influence,
-                                              fill_value=0.)
-                                              )
-                    elif resample_method == 'idw':
-                        resampled_list.append(resample_custom(
-                                              orig_def,
-                                              self.emi[vname][t, :, :].values,
-                                              self.area_def,
-                                              radius_of_influence=self.radius_of_influence,
-                                              neighbours=10,
-                                              weight_funcs=lambda r: 1/r**2,
-                                              fill_value=0.)
-                                              )
-                    elif resample_method == 'bilinear':
-                        resampled_list.append(resample_bilinear(
-                                              self.emi[vname][t, :, :].values,
-                                              orig_def,
-                                              self.area_def,
-                                              radius=self.radius_of_influence,
-                                              neighbours=10,
-                                              nprocs=4,
-                                              reduce_data=True,
-                                              segments=None,
-                                              fill_value=0.,
-                                              epsilon=0)
-                                              )
-                # combine 2d array list to one 3d
-                # ref: https://stackoverflow.com/questions/4341359/
-                #       convert-a-list-of-2d-numpy-arrays-to-one-3d-numpy-array
-                # we also need to flip the 3d array,
-                #    because of the "strange" order of WRF.
-                resampled_data = np.flip(np.rollaxis(np.dstack(resampled_list), -1), 1)[:, np.newaxis, ...]
-
-                # assign to self.chemi with dims
-                self.chemi[vname] = xr.DataArray(resampled_data,
-                                                 dims=['Time',
-                                                       'emissions_zdim',
-                                                       'south_north',
-                                                       'west_east'
-                                                       ]
-                                                 )
-
-                # add attrs needed by WRF-Chem
-                v_attrs = {'FieldType': 104,
-                           'MemoryOrder': 'XYZ',
-                           'description': vname,
-                           'stagger': '',
-                           'coordinates': 'XLONG XLAT',
-                           'units': self.emi[vname].attrs['units']
-                           }
-
-                self.chemi[vname] = self.chemi[vname].assign_attrs(v_attrs)
-
-                logging.debug(' '*8 +
-                              ' min: ' + str(self.chemi[vname].min().values) +
-                              ' max: ' + str(self.chemi[vname].max().values) +
-                              ' mean ' + str(self.chemi[vname].mean().values)
-                              )
-
-    def replace_var(self, ):
-        '''Replace variables in two wrfchemi* files: wrfchemi_00z_d<n> and wrfchemi_12z_d<n>'''
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
-        # set compression
-        comp = dict(zlib=True, complevel=5)
-        comp_t = dict(zlib=True, complevel=5, char_dim_name='DateStrLen')
-
-        # two period
+    def resample_WRF(self, geo, area_def):
+        '''
+        Resample emission species DataArray of all sectors.
+            return: array (species, kind, south_north, west_east)
+        '''
+        # stack all species: (species, kind, y, x)
+        logging.info(f'Resample {", ".join(self.vnames)} ...')
+
+        return resample_domain(self.emi[self.vnames].to_array().values,
+                               self.grid(),
+                               area_def,
+                               geo.attrs,
+                               resample_method,
+                               self.radius_of_influence,
+                               cache_dir=cache_dir,
+                               tile_size=tile_size,
+                               nprocs_tile=nprocs_tile)
+
+    def grid(self, ):
+        '''Regular grid of the cropped VITO (see domain.py)'''
+        return {'lon': np.asarray(self.emi_lon),
+                'lat': np.asarray(self.emi_lat),
+                'lon_b': self.emi_lon_b,
+                'lat_b': self.emi_lat_b}
+
+    def replace_var(self, st, et, delta, domain, wrf_emi, subdir, scale):
+        '''
+        Replace variables in two wrfchemi* files: wrfchemi_00z_d<n> and wrfchemi_12z_d<n>
+            subdir: <scenario>/<yyyymmdd>/ of the files in wrfchemi_dir and output_dir
+            scale: factors (species, kind) of the scenario
+        '''
+        # temporal and vertical factors of two period: (time, level, kind)
+        times = list(perdelta(st, et, timedelta(hours=delta)))
+        profile = load_vertical(wrf_emi.shape[1])
+        factors = vertical_factors(temporal_factors(times, wrf_emi.shape[1], month=mm),
+                                   profile).astype(emi_dtype)
         tindex = [np.arange(12), np.arange(12, 24, 1)]
 
         # generate files
-        for index, file in enumerate([wrfchemi_dir+f'wrfchemi_00z_{domain}', wrfchemi_dir+f'wrfchemi_12z_{domain}']):
-            if os.path.isfile(file):
-                ds = xr.open_dataset(file)
-                ds['E_NO'] = self.chemi['E_NO'].isel(Time=tindex[index])
-                # ds['E_PM_25'] = self.chemi['E_PM25'].isel(Time=tindex[index])
-                ds['E_SO2'] = self.chemi['E_SO2'].isel(Time=tindex[index])
-
-                encoding = {var: comp_t if var == 'Times' else comp
-                            for var in ds.data_vars}
-
-                output_file = output_dir+os.path.basename(file)
-                logging.info(f'Saving to {output_file}')
-                ds.to_netcdf(f'{output_file}',
-                             format='NETCDF4',
-                             encoding=encoding,
-                             unlimited_dims={'Time': True}
-                             )
-            else:
+        chemi_dir = wrfchemi_dir + subdir
+        for index, file in enumerate([chemi_dir+f'wrfchemi_00z_{domain}', chemi_dir+f'wrfchemi_12z_{domain}']):
+            if not os.path.isfile(file):
                 print('!!! Please run mozcart.py first !!!')
+                continue
 
-        logging.info('----- Successfully -----')
+            # check the sector tags before any file is written
+            with Dataset(file) as nc:
+                tagged = self.sector_tags(file, set(nc.variables))
+            species = self.species_data(factors[tindex[index]], wrf_emi, scale, tagged)
+
+            if overlay == 'rewrite':
+                self.rewrite_file(file, species, output_dir+subdir)
+            else:
+                self.overlay_file(file, species, output_dir+subdir)
+
+        if overlay == 'inplace':
+            # the species of MEIC are regenerated by the next run of mozcart.py
+            manifest = manifest_name(chemi_dir, domain)
+            hashes = load_manifest(manifest, [])
+            if hashes:
+                save_manifest(manifest, {name: value for name, value in hashes.items()
+                                         if name not in self.vnames})
+
+    def sector_tags(self, file, variables):
+        '''
+        Get the species with sector tags (E_<SPEC>_<SECTOR>) of mozcart.py in the file
+            variables: names of variables in the file
+        '''
+        tagged = []
+        for vname in self.vnames:
+            tags = sorted(name for name in variables if name.startswith(vname+'_'))
+            if not tags:
+                continue
+            if tags != sorted(f'{vname}_{sector}' for sector in sectors):
+                raise ValueError(f'Sector tags {", ".join(tags)} of {file} '
+                                 f'are not the MEIC sectors of VITO {sectors}')
+            tagged.append(vname)
+
+        return tagged
+
+    def species_data(self, factors, wrf_emi, scale, tagged):
+        '''
+        Generate (name, units, data) of VITO species one by one,
+            the sector tags are replaced by the kinds of VITO too
+            factors: (time, level, kind)
+            tagged: species with sector tags in the file
+        '''
+        for index, vname in enumerate(self.vnames):
+            units = self.emi[vname].attrs['units']
+            species_factors = (factors*scale[index]).astype(emi_dtype)
+            # ((time*level)*kind) .* (kind*grid) = (time*level)*grid
+            data = apply_factors(species_factors.reshape(-1, wrf_emi.shape[1]),
+                                 wrf_emi[index:index+1])[0]
+            yield vname, units, data.reshape(factors.shape[:2] + wrf_emi.shape[2:])
+
+            if vname not in tagged:
+                continue
+            for k, sector in enumerate(sectors):
+                # sector k: (time*level) .* (grid) = time*level*grid
+                data = np.multiply(species_factors[:, :, k, np.newaxis, np.newaxis],
+                                   wrf_emi[index, k])
+                yield f'{vname}_{sector}', units, data
+
+    def rewrite_file(self, file, species, save_dir):
+        '''Read all variables of the file and save them with species to save_dir'''
+        # domains may create it at the same time
+        os.makedirs(save_dir, exist_ok=True)
+
+        # set compression and precision
+        comp = dict(zlib=True, complevel=5, dtype=emi_dtype)
+        comp_t = dict(zlib=True, complevel=5, char_dim_name='DateStrLen')
+
+        ds = xr.open_dataset(file)
+        for vname, units, chemi_data in species:
+            ds[vname] = xr.DataArray(chemi_data,
+                                     dims=dims,
+                                     attrs=chemi_attrs(vname, units))
+            self.stats.add(os.path.basename(file), vname, chemi_data)
+
+        encoding = {var: comp_t if var == 'Times' else comp
+                    for var in ds.data_vars}
+
+        output_file = save_dir+os.path.basename(file)
+        logging.info(f'Saving to {output_file}')
+        ds.to_netcdf(f'{output_file}',
+                     format='NETCDF4',
+                     encoding=encoding,
+                     unlimited_dims={'Time': True}
+                     )
+
+    def overlay_file(self, file, species, save_dir):
+        '''
+        Overwrite the data of species in append mode,
+            the other variables are not read or compressed again
+            save_dir: dir of the copied file
+        '''
+        if overlay == 'copy':
+            # domains may create it at the same time
+            os.makedirs(save_dir, exist_ok=True)
+            output_file = save_dir+os.path.basename(file)
+            logging.info(f'Copying {file} to {output_file}')
+            shutil.copyfile(file, output_file)
+        elif overlay == 'inplace':
+            output_file = file
+        else:
+            raise ValueError(f'Unknown overlay: {overlay}')
+
+        logging.info(f'Overwriting {", ".join(self.vnames)} in {output_file}')
+        with Dataset(output_file, 'a') as nc:
+            for vname, units, chemi_data in species:
+                if vname in nc.variables:
+                    var = nc.variables[vname]
+                    if var.shape != chemi_data.shape:
+                        raise ValueError(f'Shape of {vname} in {output_file} {var.shape} '
+                                         f'is different from VITO {chemi_data.shape}')
+                else:
+                    var = nc.createVariable(vname, emi_dtype, dims,
+                                            zlib=True, complevel=5)
+                var.setncatts(chemi_attrs(vname, units))
+                var[:] = chemi_data
+                self.stats.add(os.path.basename(file), vname, chemi_data)
+
+
+def inventory_files():
+    '''Input files of VITO (for hashes of blend.py)'''
+    return [data_path+vito_filename]
+
+
+def inventory_settings():
+    '''Settings which change the VITO data (for hashes of blend.py)'''
+    return {'yyyy_vito': yyyy_vito,
+            'crop': crop,
+            'radius_of_influence': radius_of_influence,
+            'emi_dtype': np.dtype(emi_dtype).name}
+
+
+def read_inventory(area_defs, yyyy, mm):
+    '''
+    Read VITO of the simulated month as one inventory of blend.py
+        the month of yyyy_vito is used for the simulated year (yyyy)
+        the kinds are in the order of columns in *_factor.csv
+    '''
+    reader = vito()
+    reader.read_vito(area_defs, mm)
+    names = [name for name in reader.emi.data_vars if 'E_' in name]
+
+    return dict(reader.grid(),
+                emi={name: reader.emi[name].values for name in names},
+                units={name: reader.emi[name].attrs['units'] for name in names})
 
 
 if __name__ == '__main__':
     st = datetime(yyyy, mm, dd, minhour)
-    et = datetime(yyyy, mm, dd, maxhour)
-    vito(st, et, delta)
+    et = datetime(yyyy, mm, dd_end, maxhour)
+    vito().run(st, et, delta)